@@ -0,0 +1,69 @@
+"""
+Benchmarks ThreadStore lookup and insert cost.
+
+Usage: python bench/bench_thread_store.py [--channels 100000]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from thread_store import ThreadStore
+
+
+def report(label, count, elapsed):
+    print(f"{label:<32} {count:>8} ops  {elapsed * 1e6 / count:>9.2f} us/op  {count / elapsed:>12.0f} ops/s")
+
+
+async def run(channels, cache_size):
+    with tempfile.TemporaryDirectory() as tmp:
+        store = ThreadStore(os.path.join(tmp, "threads.db"), cache_size=cache_size)
+        ids = list(range(10**17, 10**17 + channels)) # Discord-sized snowflakes
+
+        start = time.perf_counter()
+        for channel_id in ids:
+            store.set(channel_id, f"thread_{channel_id}")
+        report("insert (memory)", channels, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await store.flush()
+        report("flush to SQLite (batched)", channels, time.perf_counter() - start)
+
+        hot = ids[-min(cache_size, channels):]
+        sample = [random.choice(hot) for _ in range(channels)]
+        start = time.perf_counter()
+        for channel_id in sample:
+            await store.get(channel_id)
+        report("lookup (cache hit)", len(sample), time.perf_counter() - start)
+
+        cold = ids[:channels - cache_size] if channels > cache_size else []
+        if cold:
+            sample = random.sample(cold, min(len(cold), 10000))
+            start = time.perf_counter()
+            for channel_id in sample:
+                await store.get(channel_id)
+            report("lookup (cache miss -> SQLite)", len(sample), time.perf_counter() - start)
+
+        store.close()
+        reopened = ThreadStore(os.path.join(tmp, "threads.db"), cache_size=cache_size)
+        start = time.perf_counter()
+        reopened._warm(await asyncio.to_thread(reopened._load_recent))
+        report("startup warm load", len(reopened), time.perf_counter() - start)
+        reopened.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--channels", type=int, default=100_000)
+    parser.add_argument("--cache-size", type=int, default=10_000)
+    args = parser.parse_args()
+    print(f"ThreadStore benchmark: {args.channels} channels, cache size {args.cache_size}")
+    asyncio.run(run(args.channels, args.cache_size))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,458 @@
+"""
+Offline stand-ins for the services Keith talks to, used by the load-test harness.
+
+FakeAssistantsServer is a local HTTP server speaking enough of the OpenAI Assistants
+API (threads, messages, polled and streamed runs) and of Chat Completions for the
+real client to drive it.
+FakeChannel / FakeMessage mimic the bits of discord.py objects that on_message uses
+and record every send and edit.
+"""
+import asyncio
+import contextlib
+import itertools
+import json
+import random
+import time
+from collections import Counter, deque
+
+from aiohttp import web
+
+
+class FakeAssistantsServer:
+    """
+    Serves /v1 Assistants endpoints on 127.0.0.1.
+
+    Runs sit in `queued` for queue_delay seconds, then `in_progress` for generation_delay
+    seconds (plus context_delay per thread message the run reads, honouring truncation_strategy)
+    before completing with output_chars characters of text. Errors can be injected:
+      thread_404_rate - chance that adding a message finds the thread gone (404)
+      rate_limit_rate - chance that any request gets a 429 with Retry-After
+      failed_run_rate - chance that a run ends `failed` instead of `completed`
+    Like OpenAI, a thread with a queued or in-progress run refuses new messages and runs, and
+    a run keeps going when the client that created it hangs up. create_run_latency delays the
+    response to creating a run, which already exists meanwhile.
+    """
+
+    def __init__(self, queue_delay=0.2, generation_delay=1.0, output_chars=400, stream_chunks=20,
+                 thread_404_rate=0.0, rate_limit_rate=0.0, failed_run_rate=0.0,
+                 context_delay=0.0, create_run_latency=0.0, requests_per_min=100000, tokens_per_min=10000000,
+                 seed=None):
+        self.queue_delay = queue_delay
+        self.generation_delay = generation_delay
+        self.output_chars = output_chars
+        self.stream_chunks = stream_chunks
+        self.context_delay = context_delay
+        self.create_run_latency = create_run_latency
+        self.thread_404_rate = thread_404_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.failed_run_rate = failed_run_rate
+        self.requests_per_min = requests_per_min
+        self.tokens_per_min = tokens_per_min
+        self.random = random.Random(seed)
+        self.ids = itertools.count(1)
+        self.calls = Counter() # endpoint name -> requests served (including injected errors)
+        self.errors = Counter() # injected error kind -> count
+        self.threads = {} # thread_id -> list of message dicts, oldest first
+        self.runs = {} # run_id -> run state dict
+        self.recent_requests = deque()
+        self.runner = None
+        self.url = None
+
+    # --- Lifecycle ---
+    async def start(self):
+        app = web.Application(middlewares=[self._middleware])
+        app.add_routes([
+            web.get("/v1/assistants/{assistant_id}", self.get_assistant),
+            web.post("/v1/threads", self.create_thread),
+            web.post("/v1/threads/{thread_id}/messages", self.create_message),
+            web.get("/v1/threads/{thread_id}/messages", self.list_messages),
+            web.delete("/v1/threads/{thread_id}/messages/{message_id}", self.delete_message),
+            web.post("/v1/threads/{thread_id}/runs", self.create_run),
+            web.get("/v1/threads/{thread_id}/runs", self.list_runs),
+            web.get("/v1/threads/{thread_id}/runs/{run_id}", self.get_run),
+            web.post("/v1/threads/{thread_id}/runs/{run_id}/cancel", self.cancel_run),
+            web.post("/v1/chat/completions", self.chat_completion),
+        ])
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0, backlog=4096)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}/v1"
+        return self
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    def reset_counters(self):
+        self.calls.clear()
+        self.errors.clear()
+
+    # --- Helpers ---
+    def _new_id(self, prefix):
+        return f"{prefix}_{next(self.ids)}"
+
+    def _rate_limit_headers(self):
+        now = time.monotonic()
+        while self.recent_requests and now - self.recent_requests[0] > 60:
+            self.recent_requests.popleft()
+        return {
+            "x-ratelimit-limit-requests": str(self.requests_per_min),
+            "x-ratelimit-remaining-requests": str(max(0, self.requests_per_min - len(self.recent_requests))),
+            "x-ratelimit-reset-requests": "1s",
+            "x-ratelimit-limit-tokens": str(self.tokens_per_min),
+            "x-ratelimit-remaining-tokens": str(self.tokens_per_min),
+            "x-ratelimit-reset-tokens": "1s",
+        }
+
+    @staticmethod
+    def _error(status, message, headers=None):
+        body = {"error": {"message": message, "type": "invalid_request_error", "param": None, "code": None}}
+        return web.json_response(body, status=status, headers=headers)
+
+    @web.middleware
+    async def _middleware(self, request, handler):
+        self.recent_requests.append(time.monotonic())
+        route = request.match_info.route.resource
+        self.calls[f"{request.method} {route.canonical if route else request.path}"] += 1
+        if self.rate_limit_rate and self.random.random() < self.rate_limit_rate:
+            self.errors["429"] += 1
+            headers = {**self._rate_limit_headers(), "retry-after": "0.2"}
+            return self._error(429, "Rate limit reached (injected).", headers)
+        response = await handler(request)
+        response.headers.update(self._rate_limit_headers())
+        return response
+
+    def _text(self):
+        words = ("keith", "thinks", "the", "answer", "is", "probably", "forty", "two", "and", "also")
+        out, length = [], 0
+        while length < self.output_chars:
+            word = self.random.choice(words)
+            out.append(word)
+            length += len(word) + 1
+        text = " ".join(out)[:self.output_chars]
+        # Break long outputs into paragraphs so Discord splitting has something to work with
+        return "\n".join(text[i:i + 300] for i in range(0, len(text), 300))
+
+    def _message(self, thread_id, role, text, run_id=None, status="completed"):
+        return {
+            "id": self._new_id("msg"), "object": "thread.message", "created_at": int(time.time()),
+            "thread_id": thread_id, "role": role, "run_id": run_id, "assistant_id": None,
+            "status": status, "attachments": [], "metadata": {},
+            "content": [{"type": "text", "text": {"value": text, "annotations": []}}] if text else [],
+        }
+
+    @staticmethod
+    def _tokens(text):
+        return len(text) // 4 + 1
+
+    def _run_json(self, run):
+        usage = None
+        if run["status"] == "completed":
+            usage = {"prompt_tokens": run["prompt_tokens"], "completion_tokens": run["completion_tokens"],
+                     "total_tokens": run["prompt_tokens"] + run["completion_tokens"]}
+        return {
+            "id": run["id"], "object": "thread.run", "created_at": int(run["created_wall"]),
+            "thread_id": run["thread_id"], "assistant_id": run["assistant_id"], "status": run["status"],
+            "last_error": run["last_error"], "model": "fake-model", "instructions": "", "tools": [],
+            "metadata": {}, "usage": usage,
+        }
+
+    def _advance(self, run):
+        """Moves a polled run along its timeline."""
+        if run["status"] in ("completed", "failed", "cancelled", "expired") or run["streaming"]:
+            return
+        elapsed = time.monotonic() - run["created"]
+        if elapsed < self.queue_delay:
+            run["status"] = "queued"
+        elif elapsed < self.queue_delay + run["generation_delay"]:
+            run["status"] = "in_progress"
+        else:
+            self._finish(run)
+
+    def _active_run(self, thread_id):
+        for run in self.runs.values():
+            if run["thread_id"] == thread_id:
+                self._advance(run)
+                if run["status"] in ("queued", "in_progress"):
+                    return run
+        return None
+
+    @staticmethod
+    def _list(data):
+        return web.json_response({"object": "list", "data": data, "has_more": False,
+                                  "first_id": data[0]["id"] if data else None,
+                                  "last_id": data[-1]["id"] if data else None})
+
+    def _finish(self, run, text=None):
+        if run["will_fail"]:
+            run["status"] = "failed"
+            run["last_error"] = {"code": "server_error", "message": "Injected failure."}
+            self.errors["failed_run"] += 1
+            return
+        text = text if text is not None else self._text()
+        run["status"] = "completed"
+        run["completion_tokens"] = self._tokens(text)
+        self.threads[run["thread_id"]].append(self._message(run["thread_id"], "assistant", text, run_id=run["id"]))
+
+    # --- Endpoints ---
+    async def get_assistant(self, request):
+        return web.json_response({"id": request.match_info["assistant_id"], "object": "assistant",
+                                  "name": "Fake Keith", "model": "fake-model", "tools": [], "created_at": 0})
+
+    async def create_thread(self, request):
+        body = await request.json() if request.can_read_body else {}
+        thread_id = self._new_id("thread")
+        self.threads[thread_id] = [self._message(thread_id, m.get("role", "user"), m.get("content", ""))
+                                   for m in body.get("messages") or []]
+        return web.json_response({"id": thread_id, "object": "thread", "created_at": int(time.time()), "metadata": {}})
+
+    async def create_message(self, request):
+        thread_id = request.match_info["thread_id"]
+        if thread_id in self.threads and self.thread_404_rate and self.random.random() < self.thread_404_rate:
+            del self.threads[thread_id]
+            self.errors["thread_404"] += 1
+        if thread_id not in self.threads:
+            return self._error(404, f"No thread found with id '{thread_id}'.")
+        active = self._active_run(thread_id)
+        if active is not None:
+            return self._error(400, f"Can't add messages to {thread_id} while a run {active['id']} is active.")
+        body = await request.json()
+        message = self._message(thread_id, body.get("role", "user"), body.get("content", ""))
+        self.threads[thread_id].append(message)
+        return web.json_response(message)
+
+    async def list_messages(self, request):
+        thread_id = request.match_info["thread_id"]
+        if thread_id not in self.threads:
+            return self._error(404, f"No thread found with id '{thread_id}'.")
+        data = list(self.threads[thread_id])
+        if request.query.get("order", "desc") == "desc":
+            data.reverse()
+        return self._list(data[:int(request.query.get("limit", 20))])
+
+    async def delete_message(self, request):
+        messages = self.threads.get(request.match_info["thread_id"], [])
+        message_id = request.match_info["message_id"]
+        if not any(m["id"] == message_id for m in messages):
+            return self._error(404, f"No message found with id '{message_id}'.")
+        messages[:] = [m for m in messages if m["id"] != message_id]
+        return web.json_response({"id": message_id, "object": "thread.message.deleted", "deleted": True})
+
+    async def create_run(self, request):
+        thread_id = request.match_info["thread_id"]
+        if thread_id not in self.threads:
+            return self._error(404, f"No thread found with id '{thread_id}'.")
+        active = self._active_run(thread_id)
+        if active is not None:
+            return self._error(400, f"Thread {thread_id} already has an active run {active['id']}.")
+        body = await request.json()
+        context = self.threads[thread_id]
+        truncation = body.get("truncation_strategy") or {}
+        if truncation.get("type") == "last_messages":
+            context = context[-truncation["last_messages"]:]
+        run = {
+            "id": self._new_id("run"), "thread_id": thread_id, "assistant_id": body.get("assistant_id"),
+            "status": "queued", "last_error": None, "created": time.monotonic(), "created_wall": time.time(),
+            "will_fail": bool(self.failed_run_rate and self.random.random() < self.failed_run_rate),
+            "generation_delay": self.generation_delay + self.context_delay * len(context),
+            "prompt_tokens": sum(self._tokens(c["text"]["value"]) for m in context for c in m["content"]),
+            "completion_tokens": 0, "streaming": bool(body.get("stream")),
+        }
+        self.runs[run["id"]] = run
+        if self.create_run_latency:
+            await asyncio.sleep(self.create_run_latency)
+        if run["streaming"]:
+            response = web.StreamResponse(headers={"Content-Type": "text/event-stream", **self._rate_limit_headers()})
+            try:
+                await response.prepare(request)
+                await self._stream_run(response, run)
+            except ConnectionResetError:
+                pass # The client hung up; the run carries on unless it gets cancelled
+            finally:
+                run["streaming"] = False
+            return response
+        return web.json_response(self._run_json(run))
+
+    async def list_runs(self, request):
+        thread_id = request.match_info["thread_id"]
+        if thread_id not in self.threads:
+            return self._error(404, f"No thread found with id '{thread_id}'.")
+        data = [r for r in self.runs.values() if r["thread_id"] == thread_id]
+        for run in data:
+            self._advance(run)
+        if request.query.get("order", "desc") == "desc":
+            data.reverse()
+        return self._list([self._run_json(r) for r in data[:int(request.query.get("limit", 20))]])
+
+    async def get_run(self, request):
+        run = self.runs.get(request.match_info["run_id"])
+        if run is None or run["thread_id"] not in self.threads:
+            return self._error(404, "No run found.")
+        self._advance(run)
+        return web.json_response(self._run_json(run))
+
+    async def cancel_run(self, request):
+        run = self.runs.get(request.match_info["run_id"])
+        if run is None:
+            return self._error(404, "No run found.")
+        if run["status"] in ("queued", "in_progress"):
+            run["status"] = "cancelled"
+        return web.json_response(self._run_json(run))
+
+    async def chat_completion(self, request):
+        """Chat Completions: queue_delay before the first chunk, then generation_delay spread over chunks."""
+        body = await request.json()
+        completion_id = self._new_id("chatcmpl")
+        if not body.get("stream"):
+            await asyncio.sleep(self.queue_delay + self.generation_delay)
+            text = self._text()
+            return web.json_response({
+                "id": completion_id, "object": "chat.completion", "created": int(time.time()),
+                "model": body.get("model", "fake-model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": sum(self._tokens(m["content"]) for m in body["messages"]),
+                          "completion_tokens": self._tokens(text), "total_tokens": 0},
+            })
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", **self._rate_limit_headers()})
+        await response.prepare(request)
+        with contextlib.suppress(ConnectionResetError): # The client hung up
+            await self._stream_chat(response, body, completion_id)
+        return response
+
+    async def _stream_chat(self, response, body, completion_id):
+        async def emit(delta, finish_reason=None):
+            chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": body.get("model", "fake-model"),
+                     "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+
+        await asyncio.sleep(self.queue_delay)
+        await emit({"role": "assistant", "content": ""})
+        text = self._text()
+        chunk_size = max(1, len(text) // max(1, self.stream_chunks))
+        for i in range(0, len(text), chunk_size):
+            await asyncio.sleep(self.generation_delay / max(1, self.stream_chunks))
+            await emit({"content": text[i:i + chunk_size]})
+        await emit({}, finish_reason="stop")
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+
+    async def _stream_run(self, response, run):
+        async def emit(event, data):
+            await response.write(f"event: {event}\ndata: {json.dumps(data)}\n\n".encode())
+
+        await emit("thread.run.created", self._run_json(run))
+        await emit("thread.run.queued", self._run_json(run))
+        await asyncio.sleep(self.queue_delay)
+        if run["status"] == "cancelled":
+            await emit("thread.run.cancelled", self._run_json(run))
+        else:
+            run["status"] = "in_progress"
+            await emit("thread.run.in_progress", self._run_json(run))
+            text = self._text()
+            if not run["will_fail"]:
+                message = self._message(run["thread_id"], "assistant", "", run_id=run["id"], status="in_progress")
+                await emit("thread.message.created", message)
+                chunk = max(1, len(text) // max(1, self.stream_chunks))
+                for i in range(0, len(text), chunk):
+                    await asyncio.sleep(run["generation_delay"] / max(1, self.stream_chunks))
+                    if run["status"] == "cancelled":
+                        break
+                    await emit("thread.message.delta", {
+                        "id": message["id"], "object": "thread.message.delta",
+                        "delta": {"content": [{"index": 0, "type": "text", "text": {"value": text[i:i + chunk]}}]},
+                    })
+            else:
+                await asyncio.sleep(run["generation_delay"])
+            if run["status"] != "cancelled":
+                self._finish(run, text)
+            await emit(f"thread.run.{run['status']}", self._run_json(run))
+        await response.write(b"event: done\ndata: [DONE]\n\n")
+        await response.write_eof()
+
+
+# --- Discord stand-ins ---
+class FakeUser:
+    def __init__(self, user_id, name):
+        self.id = user_id
+        self.name = name
+        self.display_name = name
+
+    def __str__(self):
+        return self.name
+
+
+class FakeSentMessage:
+    """A message the bot sent. Edits are recorded on the channel."""
+
+    def __init__(self, channel, message_id, content, files=()):
+        self.channel = channel
+        self.id = message_id
+        self.content = content
+        self.files = list(files)
+
+    async def edit(self, content=None, attachments=None, **kwargs):
+        await asyncio.sleep(self.channel.latency)
+        self.content = content
+        if attachments is not None:
+            self.files = list(attachments)
+        self.channel.edits.append((time.monotonic(), self.id, content))
+        return self
+
+    async def delete(self):
+        self.channel.deleted.append(self.id)
+
+
+class FakeChannel:
+    """Records every send and edit, with an optional simulated Discord API latency."""
+
+    ids = itertools.count(1)
+
+    def __init__(self, channel_id, latency=0.0):
+        self.id = channel_id
+        self.latency = latency
+        self.sent = [] # (monotonic time, FakeSentMessage)
+        self.edits = [] # (monotonic time, message id, content)
+        self.deleted = []
+
+    async def send(self, content=None, file=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        message = FakeSentMessage(self, next(self.ids), content, [file] if file else ())
+        self.sent.append((time.monotonic(), message))
+        return message
+
+    @contextlib.asynccontextmanager
+    async def _typing(self):
+        yield
+
+    def typing(self):
+        return self._typing()
+
+    def final_text(self):
+        """Everything the bot has shown in this channel, as it looks now."""
+        return "\n".join(m.content or "" for _, m in self.visible())
+
+    def visible(self):
+        """(time, message) for everything sent and not deleted since."""
+        return [(at, m) for at, m in self.sent if m.id not in self.deleted]
+
+
+class FakeMessage:
+    """An incoming user message."""
+
+    ids = itertools.count(10**17)
+
+    def __init__(self, channel, author, content):
+        self.channel = channel
+        self.author = author
+        self.content = content
+        self.guild = None
+        self.id = next(self.ids)
+
+    async def reply(self, content=None, **kwargs):
+        return await self.channel.send(content, **kwargs)
+
+    async def delete(self):
+        pass
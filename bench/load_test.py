@@ -0,0 +1,176 @@
+"""
+Offline load test for Keith's reply path.
+
+Drives the real on_message logic from keith-bot.py against a local stand-in Assistants
+server and fake Discord channels, then reports throughput, end-to-end latency
+percentiles and OpenAI calls per reply for each concurrency level.
+
+Usage: python bench/load_test.py [--channels 1 10 100 1000] [--backend assistants|chat] [--mode stream|poll] [...]
+"""
+import argparse
+import asyncio
+import importlib.util
+import logging
+import os
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from fakes import FakeAssistantsServer, FakeChannel, FakeMessage, FakeUser
+from run_journal import RunJournal
+from thread_store import ThreadStore
+
+
+def load_bot():
+    """Imports keith-bot.py (its file name isn't a valid module name)."""
+    spec = importlib.util.spec_from_file_location("keith_bot", os.path.join(REPO_DIR, "keith-bot.py"))
+    bot = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bot)
+    return bot
+
+
+def percentile(values, pct):
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+async def drive_channel(bot, channel, author, prompts):
+    """Sends prompts one after another in a channel; returns per-reply latencies."""
+    latencies = []
+    for prompt in prompts:
+        start = time.monotonic()
+        await bot.on_message(FakeMessage(channel, author, f"Keith {prompt}"))
+        worker = bot.channel_workers.get(channel.id)
+        if worker is not None:
+            await worker
+        latencies.append(time.monotonic() - start)
+    return latencies
+
+
+async def run_level(bot, server, channel_count, args, tmp):
+    server.reset_counters()
+    bot.thread_store = ThreadStore(os.path.join(tmp, f"threads-{channel_count}.db"))
+    bot.run_journal = RunJournal(os.path.join(tmp, f"threads-{channel_count}.db"), bot.boot_id)
+    bot.run_semaphore = asyncio.Semaphore(args.max_concurrent_runs)
+    channels = [FakeChannel(900000 + channel_count * 10000 + i, latency=args.discord_latency)
+                for i in range(channel_count)]
+    author = FakeUser(42, "loadtester")
+    prompts = [f"question {n} about load testing" for n in range(args.prompts_per_channel)]
+
+    runs_before = bot.metrics.totals("keith_run_seconds")
+    start = time.monotonic()
+    results = await asyncio.gather(*(drive_channel(bot, c, author, prompts) for c in channels))
+    elapsed = time.monotonic() - start
+    bot.thread_store.close()
+    bot.run_journal.close()
+
+    run_seconds = {}
+    for key, (count, total) in bot.metrics.totals("keith_run_seconds").items():
+        count_before, total_before = runs_before.get(key, (0, 0.0))
+        if count > count_before:
+            run_seconds[dict(key)["compaction"]] = (total - total_before) / (count - count_before)
+
+    latencies = [latency for channel_latencies in results for latency in channel_latencies]
+    replies = len(latencies)
+    failed = sum(1 for c in channels if "Sorry" in c.final_text() or not c.sent)
+    openai_calls = sum(server.calls.values())
+    return {
+        "channels": channel_count,
+        "replies": replies,
+        "failed": failed,
+        "throughput": replies / elapsed if elapsed else float("nan"),
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "calls_per_reply": openai_calls / replies if replies else float("nan"),
+        "edits": sum(len(c.edits) for c in channels),
+        "messages": sum(len(c.visible()) for c in channels),
+        "files": sum(len(m.files) for c in channels for _, m in c.visible()),
+        "errors": dict(server.errors),
+        "run_seconds": run_seconds,
+    }
+
+
+def print_report(rows, args):
+    print()
+    print(f"backend={args.backend}  mode={args.mode}  queue_delay={args.queue_delay}s  generation_delay={args.generation_delay}s  "
+          f"output_chars={args.output_chars}  max_concurrent_runs={args.max_concurrent_runs}")
+    header = (f"{'channels':>8} {'replies':>8} {'failed':>7} {'replies/s':>10} {'p50 s':>8} {'p95 s':>8} {'p99 s':>8} "
+              f"{'calls/reply':>12} {'edits':>7} {'msgs':>6} {'files':>6}  mean run s by compaction  injected errors")
+    print(header)
+    print("-" * len(header))
+    for r in rows:
+        runs = " ".join(f"{kind}={seconds:.2f}" for kind, seconds in sorted(r['run_seconds'].items())) or "-"
+        print(f"{r['channels']:>8} {r['replies']:>8} {r['failed']:>7} {r['throughput']:>10.2f} "
+              f"{r['p50']:>8.2f} {r['p95']:>8.2f} {r['p99']:>8.2f} {r['calls_per_reply']:>12.2f} {r['edits']:>7} "
+              f"{r['messages']:>6} {r['files']:>6}  "
+              f"{runs:<24}  {r['errors'] or '-'}")
+
+
+async def main_async(args):
+    server = await FakeAssistantsServer(
+        queue_delay=args.queue_delay, generation_delay=args.generation_delay, output_chars=args.output_chars,
+        context_delay=args.context_delay,
+        thread_404_rate=args.thread_404_rate, rate_limit_rate=args.rate_limit_rate,
+        failed_run_rate=args.failed_run_rate, seed=args.seed,
+    ).start()
+    bot = load_bot()
+    bot.ASSISTANT_ID = "asst_fake"
+    bot.BACKEND = args.backend
+    bot.STREAM_RESPONSES = args.mode == "stream"
+    bot.STREAM_EDIT_INTERVAL = args.edit_interval
+    bot.COALESCE_WINDOW = 0
+    bot.COMPACT_TRUNCATE_MESSAGES = args.truncate_messages
+    bot.COMPACT_KEEP_MESSAGES = args.keep_messages
+    bot.COMPACT_ROLLOVER_MESSAGES = args.rollover_messages
+    bot.client_openai = bot.make_openai_client("sk-fake", base_url=server.url)
+    rows = []
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            for channel_count in args.channels:
+                rows.append(await run_level(bot, server, channel_count, args, tmp))
+                print(f"... {channel_count} channels done", file=sys.stderr)
+    finally:
+        await bot.client_openai.close()
+        await server.stop()
+    print_report(rows, args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--channels", type=int, nargs="+", default=[1, 10, 100, 1000])
+    parser.add_argument("--prompts-per-channel", type=int, default=1)
+    parser.add_argument("--backend", choices=["assistants", "chat"], default="assistants")
+    parser.add_argument("--mode", choices=["stream", "poll"], default="stream", help="Assistants backend only")
+    parser.add_argument("--max-concurrent-runs", type=int, default=16)
+    parser.add_argument("--queue-delay", type=float, default=0.2)
+    parser.add_argument("--generation-delay", type=float, default=1.0)
+    parser.add_argument("--output-chars", type=int, default=400)
+    parser.add_argument("--context-delay", type=float, default=0.0,
+                        help="Extra run seconds per thread message the run reads")
+    parser.add_argument("--truncate-messages", type=int, default=40, help="COMPACT_TRUNCATE_MESSAGES")
+    parser.add_argument("--keep-messages", type=int, default=20, help="COMPACT_KEEP_MESSAGES")
+    parser.add_argument("--rollover-messages", type=int, default=200, help="COMPACT_ROLLOVER_MESSAGES")
+    parser.add_argument("--edit-interval", type=float, default=0.5)
+    parser.add_argument("--discord-latency", type=float, default=0.05)
+    parser.add_argument("--thread-404-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--failed-run-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--verbose", action="store_true", help="Show the bot's own INFO logs")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.ERROR,
+                        format="%(asctime)s %(levelname)-7s %(name)s: %(message)s")
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
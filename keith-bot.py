@@ -1,65 +1,406 @@
 # --- Start of Original Code ---
+import time # Needed for polling delay
+STARTED_AT = time.perf_counter() # Cold-start timing (--check) includes the imports below
 import discord
 import openai
 import os
-import time # Needed for polling delay
+import random
+import re
+import heapq
+import itertools
+import logging
+import logging.handlers
+import queue
+import atexit
+import contextlib
+from collections import OrderedDict, deque
 
 # --- Added Imports for HalcM ---
 import asyncio
-try:
-    import tkinter as tk
-    from tkinter import simpledialog
-    TKINTER_AVAILABLE = True
-except ImportError:
-    print("WARNING: tkinter library not found. The 'HalcM' command requires it.")
-    print("         On Debian/Ubuntu: sudo apt-get install python3-tk")
-    print("         On Fedora: sudo dnf install python3-tkinter")
-    print("         On Windows/macOS: Should be included with Python install.")
-    TKINTER_AVAILABLE = False
+import abc
+import importlib.util # tkinter itself is only imported on the first HalcM
+import json
 import threading
-import queue
+import socket
+import sys
+import argparse
+import signal
+import subprocess
+import uuid
 
-BOT_TOKEN = "" # dont hard code this, I'm just lazy
-OPENAI_API_KEY = ""
-ASSISTANT_ID = ""
+from thread_store import ThreadStore
+from metrics import Metrics
+from shared_limits import SharedRateLimits
+from run_journal import RunJournal
+from outbound import OutboundSender, chunk_message
+
+# Settings below are defaults. Override them in a JSON config file or the environment
+# (see "Configuration Loading" below) rather than editing them here.
+BOT_TOKEN = "" # env DISCORD_BOT_TOKEN
+OPENAI_API_KEY = "" # env OPENAI_API_KEY
+ASSISTANT_ID = "" # env ASSISTANT_ID
 
 # --- Added Configuration for HalcM ---
-# IMPORTANT: Replace 0 with your actual Discord User ID.
-ALLOWED_USER_ID =  0 # <<<!!! REPLACE 0 WITH YOUR ACTUAL USER ID !!!>>>
-
-
-if not BOT_TOKEN:
-    print("ERROR: DISCORD_BOT_TOKEN environment variable not set.")
-    exit()
-if not OPENAI_API_KEY:
-    print("ERROR: OPENAI_API_KEY environment variable not set.")
-    exit()
-if not ASSISTANT_ID:
-    print("ERROR: ASSISTANT_ID environment variable not set.")
-    print("Please create an Assistant in the OpenAI portal (platform.openai.com/assistants)")
-    print("and set its ID (asst_...) as the ASSISTANT_ID environment variable.")
-    exit()
-if ALLOWED_USER_ID == 0:
-    print("ERROR: ALLOWED_USER_ID is not set in the script.")
-    print("       Please edit the script and replace 0 with your Discord User ID.")
-    exit()
-
-client_openai = openai.OpenAI(api_key=OPENAI_API_KEY)
-channel_threads = {}
+# IMPORTANT: Set this to your actual Discord User ID.
+ALLOWED_USER_ID =  0 # env ALLOWED_USER_ID
+# Where HalcM reads manual messages from:
+#   "tk"     - popup dialog on the machine running the bot (needs tkinter and a display)
+#   "stdin"  - type lines into the bot's console
+#   "socket" - connect to a local UNIX socket, e.g. `nc -U /tmp/keith-manual.sock`
+MANUAL_INPUT_SOURCE = "tk"
+MANUAL_SOCKET_PATH = "/tmp/keith-manual.sock"
+MANUAL_BATCH_WINDOW = 1.0 # Lines for the same channel queued within this many seconds of the first are sent as one message
+
+# Maximum number of Keith requests talking to OpenAI at the same time (across all channels).
+# Extra requests wait their turn instead of piling onto the API.
+MAX_CONCURRENT_RUNS = 16
+RUN_TIMEOUT = 300 # Maximum seconds to wait for a run to finish
+RUN_CANCEL_TIMEOUT = 10 # Seconds an edited prompt waits for its old run to finish cancelling
+ORPHAN_RUN_LOOKUPS = 3 # Times (a second apart) to look for a run whose create call was cut off by an edit
+
+# OpenAI rate-limit governor: every OpenAI call takes budget from a requests bucket and an
+# estimated-tokens bucket first. The starting sizes are guesses; the real limits are learned
+# from OpenAI's x-ratelimit-* response headers.
+OPENAI_REQUESTS_PER_MIN = 500
+OPENAI_TOKENS_PER_MIN = 200000
+GOVERNOR_MAX_WAITERS = 200 # Calls allowed to wait for budget before new runs are turned away
+GOVERNOR_CONTROL_RESERVE = 0.1 # Fraction of the budget only polls/cancels may use
+RUN_TOKEN_ESTIMATE = 1500 # Rough token cost of a run on top of the prompt itself
+OPENAI_MAX_RETRIES = 2 # Retries for 429s, 5xx and connection errors, each admitted by the governor again
+
+# Run polling: every pending run is polled by one shared task. Each run starts with a
+# short interval and backs off exponentially (with jitter) the longer it takes.
+POLL_INITIAL_INTERVAL = 0.3
+POLL_MAX_INTERVAL = 5.0
+POLL_BACKOFF = 1.5
+POLL_JITTER = 0.2 # +/- fraction applied to each interval
+POLL_REQUEST_TIMEOUT = 15 # Seconds one runs.retrieve may take before that poll is given up and retried
+
+# Conversation backend:
+#   "assistants" - OpenAI Assistants API with a thread per channel (the original flow)
+#   "chat"       - one streaming Chat Completions request per reply, with recent history kept locally
+BACKEND = "assistants"
+CHANNEL_BACKENDS = {} # channel_id -> "assistants" or "chat", overrides BACKEND for that channel
+CHAT_MODEL = None # None = use the Assistant's model (falls back to CHAT_DEFAULT_MODEL)
+CHAT_DEFAULT_MODEL = "gpt-4o-mini"
+CHAT_SYSTEM_PROMPT = None # None = use the Assistant's instructions
+CHAT_HISTORY_MESSAGES = 20 # Messages (user + Keith) remembered per channel by the chat backend
+CHAT_HISTORY_CHANNELS = 10000 # Channels whose chat history is kept in memory
+
+# Per-channel prompt queue: a channel only ever has one run in flight. Prompts that arrive
+# meanwhile are buffered and answered together by a single follow-up run.
+COALESCE_WINDOW = 0.75 # Seconds of quiet to wait for more prompts before starting the follow-up run
+MAX_CHANNEL_QUEUE_DEPTH = 5 # Buffered prompts per channel before we start turning people away
+
+# Channel -> thread mapping is kept in a local SQLite file so conversations survive restarts
+THREAD_DB_PATH = "keith_threads.db"
+THREAD_CACHE_SIZE = 10000 # Channels kept in memory
+THREAD_TTL_DAYS = 30 # Forget a channel's thread after this many days without use
+
+# Thread compaction: a channel's thread keeps growing, and every run reprocesses it. Past the
+# truncate thresholds runs only read the last COMPACT_KEEP_MESSAGES messages; past the rollover
+# thresholds the channel moves to a fresh thread seeded with a short summary of the old one.
+# Token counts are estimates (from run usage where OpenAI reports it).
+COMPACT_TRUNCATE_MESSAGES = 40
+COMPACT_TRUNCATE_TOKENS = 8000
+COMPACT_KEEP_MESSAGES = 20
+COMPACT_ROLLOVER_MESSAGES = 200 # Set any threshold to None to turn it off
+COMPACT_ROLLOVER_TOKENS = 32000
+COMPACT_SUMMARY_MESSAGES = 30 # Most recent messages of the old thread that go into the summary
+COMPACT_SUMMARY_MODEL = None # None = same model as the chat backend
+# channel_id -> overrides for that channel, e.g. {1234: {"truncate_tokens": 4000, "rollover_messages": None}}
+CHANNEL_COMPACTION = {}
+
+# Sharding: with SHARD_COUNT = None Keith runs as a single discord.Client, as it always has.
+# Set SHARD_COUNT to a number (or "auto" for Discord's recommendation) to run a supervisor that
+# splits the shards across SHARD_PROCESSES worker processes, each an AutoShardedClient.
+# Workers share THREAD_DB_PATH for channel threads and OpenAI rate-limit state, so any worker
+# can pick up a channel after a restart. Worker N serves metrics on METRICS_PORT + N and reads
+# socket manual input from MANUAL_SOCKET_PATH with "-N" added (console input isn't available).
+SHARD_COUNT = None
+SHARD_PROCESSES = 2
+SHARD_IDENTIFY_INTERVAL = 5.0 # Seconds between shard logins (Discord allows one per 5s by default)
+GOVERNOR_SYNC_INTERVAL = 1.0 # Seconds between rate-limit state exchanges with the other workers
+
+# Observability
+LOG_LEVEL = "INFO" # DEBUG, INFO, WARNING or ERROR
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = None # e.g. 9108 to serve Prometheus metrics at http://127.0.0.1:9108/metrics
+
+
+# Streaming mode: post a placeholder and edit it as the Assistant types, instead of
+# waiting for the whole run and sending the answer at once.
+STREAM_RESPONSES = True
+STREAM_EDIT_INTERVAL = 1.2 # Seconds between edits (Discord allows ~5 edits per 5s per channel)
+STREAM_PLACEHOLDER = "…"
+
+# Outbound: everything Keith posts goes through one queue per channel, paced to Discord's
+# rate limits so messages wait their turn instead of getting 429s.
+DISCORD_MESSAGE_LIMIT = 2000
+DISCORD_CHANNEL_BURST = 5 # Messages a channel can take back to back...
+DISCORD_CHANNEL_RATE = 1.0 # ...refilling at this many per second (Discord allows ~5 per 5s)
+DISCORD_GLOBAL_RATE = 45.0 # Requests per second across the bot (Discord's global limit is 50)
+ATTACH_REPLIES_OVER = 8000 # Longer answers are posted as a short preview plus a text file
+
+
+# --- Configuration Loading ---
+# Any setting above can be overridden without editing the script: first by a JSON file keyed
+# by setting name (path from KEITH_CONFIG, default keith_config.json if it exists), then by
+# environment variables named KEITH_<SETTING>. Secrets keep their usual variable names.
+# Environment values are read as the setting's type; dicts, lists and None settings take JSON.
+# Values must have the type of the setting's default, except that thresholds listed in
+# NULLABLE_SETTINGS can also be null to turn them off.
+CONFIG_PATH = os.environ.get("KEITH_CONFIG", "keith_config.json")
+SECRET_ENV_VARS = {
+    "BOT_TOKEN": "DISCORD_BOT_TOKEN",
+    "OPENAI_API_KEY": "OPENAI_API_KEY",
+    "ASSISTANT_ID": "ASSISTANT_ID",
+    "ALLOWED_USER_ID": "ALLOWED_USER_ID",
+}
+LOG_LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR")
+NULLABLE_SETTINGS = ("COMPACT_TRUNCATE_MESSAGES", "COMPACT_TRUNCATE_TOKENS",
+                     "COMPACT_ROLLOVER_MESSAGES", "COMPACT_ROLLOVER_TOKENS")
+config_errors = [] # Problems found while loading, reported by check_config()
+config_file_loaded = False
+
+
+def _setting_names(namespace):
+    return [name for name, value in namespace.items()
+            if name.isupper() and name not in ("STARTED_AT", "CONFIG_PATH", "SECRET_ENV_VARS")
+            and isinstance(value, (str, int, float, dict, list, type(None)))]
+
+
+def _channel_keys(value):
+    """JSON object keys are strings; per-channel settings are keyed by int channel ID."""
+    if isinstance(value, dict):
+        return {int(key) if isinstance(key, str) and key.isdigit() else key: item for key, item in value.items()}
+    return value
+
+
+_setting_type_names = {bool: "true or false", int: "a whole number", float: "a number", str: "a string",
+                       dict: "a JSON object", list: "a JSON list"}
+
+
+def _parse_env_setting(raw, default, nullable=False):
+    """Converts an environment value to the type of the setting's default."""
+    if nullable and raw.lower() in ("null", "none"):
+        return None
+    if isinstance(default, bool):
+        if raw.lower() in ("1", "true", "yes", "on"):
+            return True
+        if raw.lower() in ("0", "false", "no", "off"):
+            return False
+        raise ValueError("expected true or false")
+    if isinstance(default, str):
+        return raw
+    if isinstance(default, int):
+        return int(raw)
+    if isinstance(default, float):
+        return float(raw)
+    try:
+        return json.loads(raw)
+    except ValueError:
+        if default is None:
+            return raw # e.g. KEITH_CHAT_MODEL=gpt-4o or KEITH_SHARD_COUNT=auto
+        raise
+
+
+def _check_setting_type(value, default, nullable=False):
+    """Raises ValueError unless value has the type of the setting's default. Returns the value to use."""
+    if default is None or (value is None and nullable):
+        return value
+    if isinstance(default, float) and type(value) is int:
+        return float(value)
+    if type(value) is not type(default): # Also keeps true from passing as 1
+        expected = _setting_type_names[type(default)] + (" or null" if nullable else "")
+        raise ValueError(f"expected {expected}, got {json.dumps(value)}")
+    return value
+
+
+def load_config(namespace):
+    """Applies the config file and environment overrides to the settings in `namespace`."""
+    global config_file_loaded
+    names = _setting_names(namespace)
+    if os.path.exists(CONFIG_PATH):
+        try:
+            with open(CONFIG_PATH, encoding="utf-8") as f:
+                overrides = json.load(f)
+            if not isinstance(overrides, dict):
+                raise ValueError("expected a JSON object of setting names to values")
+            config_file_loaded = True
+        except (OSError, ValueError) as e:
+            config_errors.append(f"Could not read config file {CONFIG_PATH}: {e}")
+            overrides = {}
+        for name, value in overrides.items():
+            if name not in names:
+                config_errors.append(f"Unknown setting '{name}' in {CONFIG_PATH}.")
+                continue
+            try:
+                namespace[name] = _channel_keys(_check_setting_type(value, namespace[name], name in NULLABLE_SETTINGS))
+            except ValueError as e:
+                config_errors.append(f"Invalid value for {name} in {CONFIG_PATH}: {e}")
+    for name in names:
+        env_name = SECRET_ENV_VARS.get(name, f"KEITH_{name}")
+        raw = os.environ.get(env_name)
+        if raw is None:
+            continue
+        nullable = name in NULLABLE_SETTINGS
+        try:
+            value = _parse_env_setting(raw, namespace[name], nullable)
+            namespace[name] = _channel_keys(_check_setting_type(value, namespace[name], nullable))
+        except ValueError as e:
+            config_errors.append(f"Invalid value for {env_name}: {e}")
+
+
+load_config(globals())
+LOG_LEVEL = LOG_LEVEL.upper() # e.g. KEITH_LOG_LEVEL=debug
+
+
+log = logging.getLogger("keith")
+
+
+def setup_logging(process_name=None):
+    """
+    Routes all log records through a queue to a background thread that writes them to stdout,
+    so a slow or blocked stdout can never stall the event loop.
+    process_name tags every line, so interleaved supervisor/worker output stays readable.
+    """
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler(sys.stdout)
+    tag = f"[{process_name}] " if process_name else ""
+    handler.setFormatter(logging.Formatter(f"%(asctime)s %(levelname)-7s {tag}%(name)s: %(message)s"))
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    root = logging.getLogger()
+    root.handlers[:] = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(LOG_LEVEL if LOG_LEVEL in LOG_LEVELS else "INFO") # check_config() reports a bad one
+    listener.start()
+    atexit.register(listener.stop) # Flushes whatever is still queued on exit
+    return listener
+
+
+def check_config():
+    """Logs anything missing from the configuration. Returns True if the bot can start."""
+    ok = not config_errors
+    for error in config_errors:
+        log.error(error)
+    if config_file_loaded:
+        log.info(f"Loaded settings from {CONFIG_PATH}.")
+    if LOG_LEVEL not in LOG_LEVELS:
+        log.error(f"LOG_LEVEL must be one of {', '.join(LOG_LEVELS)} (got {LOG_LEVEL!r}).")
+        ok = False
+    if not BOT_TOKEN:
+        log.error("DISCORD_BOT_TOKEN environment variable not set (or BOT_TOKEN in the config file).")
+        ok = False
+    if not OPENAI_API_KEY:
+        log.error("OPENAI_API_KEY environment variable not set.")
+        ok = False
+    if not ASSISTANT_ID and "assistants" in (BACKEND, *CHANNEL_BACKENDS.values()):
+        log.error("ASSISTANT_ID environment variable not set.")
+        log.error("Please create an Assistant in the OpenAI portal (platform.openai.com/assistants)")
+        log.error("and set its ID (asst_...) as the ASSISTANT_ID environment variable.")
+        ok = False
+    if SHARD_COUNT is not None and SHARD_COUNT != "auto" and (not isinstance(SHARD_COUNT, int) or SHARD_COUNT < 1):
+        log.error(f"SHARD_COUNT must be None, \"auto\" or a positive number (got {SHARD_COUNT!r}).")
+        ok = False
+    for backend_name in {BACKEND, *CHANNEL_BACKENDS.values()}:
+        if backend_name not in BACKENDS:
+            log.error(f"Unknown backend '{backend_name}'. Use one of: {', '.join(BACKENDS)}.")
+            ok = False
+    if ALLOWED_USER_ID == 0:
+        log.error("ALLOWED_USER_ID is not set.")
+        log.error("       Set the ALLOWED_USER_ID environment variable (or config file entry) to your Discord User ID.")
+        ok = False
+    if SHARD_COUNT is not None and MANUAL_INPUT_SOURCE == "stdin":
+        log.warning('Sharded workers have no console, so HalcM is disabled. Use MANUAL_INPUT_SOURCE = "socket" or "tk".')
+    if MANUAL_INPUT_SOURCE == "tk" and not tkinter_available():
+        log.warning("tkinter library not found. The 'HalcM' command requires it.")
+        log.warning("         On Debian/Ubuntu: sudo apt-get install python3-tk")
+        log.warning("         On Fedora: sudo dnf install python3-tkinter")
+        log.warning("         On Windows/macOS: Should be included with Python install.")
+    return ok
+
+async def _on_openai_response(response):
+    """httpx response hook: feeds every OpenAI response's rate-limit headers to the governor."""
+    openai_governor.observe(response.status_code, response.headers)
+
+def make_openai_client(api_key, base_url=None):
+    """Async client so OpenAI round trips never block the Discord event loop."""
+    return openai.AsyncOpenAI(
+        api_key=api_key,
+        base_url=base_url,
+        max_retries=0, # call_openai retries through the governor instead
+        http_client=openai.DefaultAsyncHttpxClient(event_hooks={"response": [_on_openai_response]}),
+    )
+
+client_openai = None # Created in main() (the load-test harness swaps in its own)
+thread_store = ThreadStore(THREAD_DB_PATH, cache_size=THREAD_CACHE_SIZE, ttl=THREAD_TTL_DAYS * 24 * 3600)
+worker_index = None # Set in sharded worker processes
+boot_id = uuid.uuid4().hex # Identifies this process in the run journal
+run_journal = RunJournal(THREAD_DB_PATH, boot_id) # In-flight runs, resumed after a restart
+background_tasks = {} # name -> task started by start_background()
+startup_times = {} # Milestones of this process's start-up (perf_counter), for --check and metrics
+check_mode = False # --check: measure start-up, then exit
+check_passed = None
+shared_limits = None # Rate-limit state exchange with the other workers (sharded mode only)
+metrics_server = None
+assistant_profile = None # The Assistant, looked up in the background at startup (model/instructions for the chat backend)
+run_semaphore = asyncio.Semaphore(MAX_CONCURRENT_RUNS)
+outbound = OutboundSender(DISCORD_MESSAGE_LIMIT, ATTACH_REPLIES_OVER, DISCORD_CHANNEL_BURST,
+                          DISCORD_CHANNEL_RATE, DISCORD_GLOBAL_RATE)
+channel_queues = {} # channel_id -> list of QueuedPrompt waiting for the channel's next run
+channel_workers = {} # channel_id -> task answering that channel's queue
+active_replies = {} # message_id -> ActiveReply answering it, for every prompt in the batch
 
 manual_mode_active = False
 manual_mode_channel_id = None
 manual_mode_lock = threading.Lock()
-message_queue = queue.Queue()
+manual_queue = asyncio.Queue() # (channel_id, text, queued_at) handed over from the input thread
+_tkinter_modules = None # (tkinter, simpledialog) once imported, False if the import failed
 
 intents = discord.Intents.default()
 intents.message_content = True
 client_discord = discord.Client(intents=intents)
 
 # --- Added Helper Functions for HalcM ---
+def manual_input_available():
+    """Whether the configured MANUAL_INPUT_SOURCE can be used on this machine."""
+    if MANUAL_INPUT_SOURCE == "tk":
+        return tkinter_available()
+    if MANUAL_INPUT_SOURCE == "socket":
+        return hasattr(socket, "AF_UNIX")
+    return MANUAL_INPUT_SOURCE == "stdin" and worker_index is None # Workers don't get the console
+
+def manual_socket_path():
+    """MANUAL_SOCKET_PATH, made unique per worker process in sharded mode."""
+    if worker_index is None:
+        return MANUAL_SOCKET_PATH
+    base, ext = os.path.splitext(MANUAL_SOCKET_PATH)
+    return f"{base}-{worker_index}{ext}"
+
+def tkinter_available():
+    """Whether tkinter is installed. Only looks for it; the import waits for the first HalcM."""
+    if _tkinter_modules is not None:
+        return bool(_tkinter_modules)
+    return importlib.util.find_spec("tkinter") is not None
+
+def load_tkinter():
+    """Imports tkinter on first use. Returns (tkinter, simpledialog), or None if it can't be imported."""
+    global _tkinter_modules
+    if _tkinter_modules is None:
+        try:
+            import tkinter
+            from tkinter import simpledialog
+            _tkinter_modules = (tkinter, simpledialog)
+        except ImportError as e:
+            log.error(f"Could not import tkinter: {e}")
+            _tkinter_modules = False
+    return _tkinter_modules or None
+
 def _show_dialog():
     """Shows a Tkinter simpledialog and returns the input."""
-    if not TKINTER_AVAILABLE: return None
+    modules = load_tkinter()
+    if modules is None: return None
+    tk, simpledialog = modules
     user_input = None
     try:
         root = tk.Tk()
@@ -68,104 +409,753 @@ def _show_dialog():
         user_input = simpledialog.askstring("Manual Bot Input", "Enter message (or 'stop' to exit):", parent=root)
         root.destroy()
     except Exception as e:
-        print(f"[GUI Thread] Error creating Tkinter dialog: {e}")
+        log.error(f"[GUI Thread] Error creating Tkinter dialog: {e}")
         try: root.destroy()
         except: pass
     return user_input
 
-def run_manual_input_loop(target_channel_id):
+def _read_stdin_line():
+    """Reads one line from the console. Returns None on EOF."""
+    sys.stdout.write("[Manual Mode] Enter message (or 'stop' to exit): ")
+    sys.stdout.flush()
+    line = sys.stdin.readline()
+    return line.rstrip("\n") if line else None
+
+class _SocketInput:
+    """Reads manual messages line by line from clients of a local UNIX socket."""
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path):
+            os.unlink(path) # Stale socket from a previous run
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen(1)
+        self.server.settimeout(1.0) # So we notice when manual mode is switched off
+        self.conn = None
+        self.reader = None
+        log.info(f"[Manual Mode Thread] Listening for manual messages on {path}")
+
+    def read(self):
+        """Returns the next line, or None if manual mode was deactivated while waiting."""
+        while True:
+            if self.reader is None:
+                try:
+                    self.conn, _ = self.server.accept()
+                except socket.timeout:
+                    with manual_mode_lock:
+                        if not manual_mode_active:
+                            return None
+                    continue
+                self.conn.settimeout(None)
+                self.reader = self.conn.makefile("r", encoding="utf-8")
+            line = self.reader.readline()
+            if line:
+                return line.rstrip("\n")
+            self._drop_client() # Client disconnected, wait for the next one
+
+    def _drop_client(self):
+        try:
+            self.reader.close()
+            self.conn.close()
+        except Exception: pass
+        self.reader = None
+        self.conn = None
+
+    def close(self):
+        if self.reader is not None:
+            self._drop_client()
+        self.server.close()
+        try: os.unlink(self.path)
+        except OSError: pass
+
+def run_manual_input_loop(target_channel_id, loop):
     """
-    Continuously prompts the user for input via Tkinter dialog
-    until 'stop' is entered or the dialog is cancelled.
-    Runs in a separate thread.
+    Continuously reads manual messages from MANUAL_INPUT_SOURCE (Tkinter dialog, console or socket)
+    until 'stop' is entered or the input is cancelled/closed.
+    Runs in a separate thread and hands each message to the event loop without polling.
     """
     global manual_mode_active, manual_mode_channel_id
 
-    print(f"[Manual Mode Thread] Started for channel {target_channel_id}.")
-    while True:
-        with manual_mode_lock:
-            if not manual_mode_active:
-                print("[Manual Mode Thread] Mode deactivated externally. Exiting loop.")
-                break
+    log.info(f"[Manual Mode Thread] Started for channel {target_channel_id} (input: {MANUAL_INPUT_SOURCE}).")
+    socket_input = None
+    try:
+        if MANUAL_INPUT_SOURCE == "socket":
+            socket_input = _SocketInput(manual_socket_path())
+            read_input = socket_input.read
+        elif MANUAL_INPUT_SOURCE == "stdin":
+            read_input = _read_stdin_line
+        else:
+            read_input = _show_dialog
 
-        manual_input = _show_dialog()
+        while True:
+            with manual_mode_lock:
+                if not manual_mode_active:
+                    log.info("[Manual Mode Thread] Mode deactivated externally. Exiting loop.")
+                    break
 
-        if manual_input is None:
-            print("[Manual Mode Thread] Dialog cancelled by user. Exiting loop.")
-            break
+            manual_input = read_input()
 
-        if manual_input.strip().lower() == 'stop':
-            print("[Manual Mode Thread] 'stop' command received. Exiting loop.")
-            break
+            if manual_input is None:
+                log.info("[Manual Mode Thread] Input cancelled or closed. Exiting loop.")
+                break
 
-        if manual_input:
-            print(f"[Manual Mode Thread] Queuing message for channel {target_channel_id}: '{manual_input}'")
-            message_queue.put((target_channel_id, manual_input))
+            if manual_input.strip().lower() == 'stop':
+                log.info("[Manual Mode Thread] 'stop' command received. Exiting loop.")
+                break
+
+            if manual_input:
+                log.info(f"[Manual Mode Thread] Queuing message for channel {target_channel_id}: '{manual_input}'")
+                try:
+                    loop.call_soon_threadsafe(manual_queue.put_nowait, (target_channel_id, manual_input, time.monotonic()))
+                except RuntimeError:
+                    log.info("[Manual Mode Thread] Event loop is closed. Exiting loop.")
+                    break
+    except Exception as e:
+        log.error(f"[Manual Mode Thread] Error reading manual input: {e}")
+    finally:
+        if socket_input is not None:
+            socket_input.close()
 
-    print(f"[Manual Mode Thread] Loop finished for channel {target_channel_id}.")
+    log.info(f"[Manual Mode Thread] Loop finished for channel {target_channel_id}.")
     with manual_mode_lock:
         if manual_mode_channel_id == target_channel_id:
             manual_mode_active = False
             manual_mode_channel_id = None
-            print("[Manual Mode Thread] Manual mode deactivated.")
+            log.info("[Manual Mode Thread] Manual mode deactivated.")
         else:
-             print(f"[Manual Mode Thread] Warning: Manual mode state mismatch on exit? (current target: {manual_mode_channel_id})")
+             log.warning(f"[Manual Mode Thread] Manual mode state mismatch on exit? (current target: {manual_mode_channel_id})")
+
+async def _take_batch(first):
+    """
+    Collects the lines from manual_queue that belong with `first` (same channel, queued
+    within MANUAL_BATCH_WINDOW of it, fits in one Discord message), waiting out the rest
+    of the window for more to arrive. Returns (texts, leftover item or None).
+    """
+    channel_id, text, first_queued_at = first
+    deadline = first_queued_at + MANUAL_BATCH_WINDOW
+    texts = [text]
+    length = len(text)
+    while True:
+        remaining = deadline - time.monotonic()
+        try:
+            if remaining > 0 and manual_queue.empty():
+                item = await asyncio.wait_for(manual_queue.get(), timeout=remaining)
+            else:
+                item = manual_queue.get_nowait()
+        except (asyncio.TimeoutError, asyncio.QueueEmpty):
+            return texts, None
+        next_channel_id, next_text, queued_at = item
+        if (next_channel_id != channel_id or queued_at > deadline
+                or length + 1 + len(next_text) > DISCORD_MESSAGE_LIMIT):
+            return texts, item
+        texts.append(next_text)
+        length += 1 + len(next_text)
 
-async def check_message_queue():
-    """Periodically checks the message queue and sends messages to Discord."""
-    print("[Queue Task] Starting message queue processor.")
+async def send_manual_messages():
+    """Sends messages handed over by the manual input thread. Sleeps until one arrives."""
+    log.info("[Queue Task] Starting manual message sender.")
+    carried = None
     while True:
+        item = carried if carried is not None else await manual_queue.get()
+        carried = None
+        channel_id = item[0]
+        texts = [item[1]]
         try:
-            channel_id, text_to_send = message_queue.get_nowait()
+            texts, carried = await _take_batch(item)
+            text_to_send = "\n".join(texts)
             target_channel = client_discord.get_channel(channel_id)
             if target_channel:
-                try:
-                    await target_channel.send(text_to_send)
-                    print(f"[Queue Task] Sent message to channel {channel_id}.")
-                    message_queue.task_done()
-                except discord.Forbidden:
-                    print(f"[Queue Task] Error: Missing permissions to send to channel {channel_id}.")
-                except discord.HTTPException as e:
-                    print(f"[Queue Task] Error: Failed to send message to channel {channel_id}: {e}")
-                except Exception as e:
-                     print(f"[Queue Task] Error: Unexpected error sending message to {channel_id}: {e}")
+                await outbound.send(target_channel, text_to_send)
+                log.info(f"[Queue Task] Sent {len(texts)} line(s) to channel {channel_id}.")
             else:
-                print(f"[Queue Task] Error: Could not find channel {channel_id}. Discarding message.")
-                message_queue.task_done()
-
-        except queue.Empty:
-            await asyncio.sleep(0.2)
+                log.error(f"[Queue Task] Could not find channel {channel_id}. Discarding message.")
+        except discord.Forbidden:
+            log.error(f"[Queue Task] Missing permissions to send to channel {channel_id}.")
+        except discord.HTTPException as e:
+            log.error(f"[Queue Task] Failed to send message to channel {channel_id}: {e}")
         except Exception as e:
-            print(f"[Queue Task] Error processing message queue: {e}")
-            await asyncio.sleep(1)
+            log.error(f"[Queue Task] Unexpected error sending message to {channel_id}: {e}")
+        finally:
+            for _ in texts:
+                manual_queue.task_done()
 
-@client_discord.event
-async def on_ready():
-    print(f'Logged in as {client_discord.user}')
-    # Optional: Verify the Assistant ID is valid on startup
+def ensure_manual_sender():
+    """Starts the manual message sender task unless it is already running."""
+    start_background("manual_sender", send_manual_messages)
+
+# --- Background Tasks ---
+def start_background(name, make_coro, once=False):
+    """
+    Starts make_coro() as background task `name` unless it is still running (or, with once=True,
+    was ever started). on_ready runs again after every gateway reconnect, so anything it starts
+    goes through here to never run twice.
+    """
+    task = background_tasks.get(name)
+    if task is not None and (once or not task.done()):
+        return task
+    task = background_tasks[name] = asyncio.create_task(make_coro(), name=f"keith-{name}")
+    task.add_done_callback(_log_background_failure)
+    return task
+
+def _log_background_failure(task):
+    if not task.cancelled() and task.exception() is not None:
+        log.error(f"Background task {task.get_name()} failed: {task.exception()!r}")
+
+# --- OpenAI Rate-Limit Governor ---
+PRIORITY_CONTROL = 0 # Run polls and cancels: keep in-flight work moving
+PRIORITY_NORMAL = 1 # Thread/message creation and reading replies
+PRIORITY_NEW_RUN = 2 # Starting new runs
+
+RATE_LIMIT_REPLY = "Sorry, I'm getting too many requests right now (Rate Limit). Please try again in a moment."
+AUTH_ERROR_REPLY = "Sorry, there's an issue with my connection to the AI (Authentication Error). Please tell the bot owner."
+UNEXPECTED_ERROR_REPLY = "Sorry, an unexpected error occurred while getting the response."
+
+
+class GovernorQueueFull(Exception):
+    """Raised when too many OpenAI calls are already waiting for rate-limit budget."""
+
+
+class TokenBucket:
+    """Refills continuously up to `capacity` per minute."""
+
+    def __init__(self, capacity):
+        self.capacity = float(capacity)
+        self.level = float(capacity)
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def seconds_until(self, amount):
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) * 60 / max(self.capacity, 1)
+
+    def sync(self, limit, remaining, now):
+        """Adopts the limit/remaining numbers OpenAI reported."""
+        self.refill(now)
+        if limit and float(limit) != self.capacity:
+            # Our starting guess was off; shift the level by the same amount as the capacity
+            self.level = max(0.0, self.level + float(limit) - self.capacity)
+            self.capacity = float(limit)
+        if remaining is not None:
+            self.level = min(self.level, float(remaining))
+
+
+class OpenAIGovernor:
+    """
+    Admission control in front of every OpenAI call.
+    Calls over budget wait in a bounded priority queue instead of failing, and the
+    control lane (polls/cancels) can dip into a reserve that new runs can't touch.
+    """
+
+    def __init__(self, requests_per_min, tokens_per_min, max_waiters):
+        self.requests = TokenBucket(requests_per_min)
+        self.tokens = TokenBucket(tokens_per_min)
+        self.max_waiters = max_waiters
+        self.waiters = [] # heap of [priority, seq, tokens, future]
+        self.seq = itertools.count()
+        self.blocked_until = 0.0
+        self.timer = None
+        self.last_report = 0.0
+        self.spent_requests = 0 # Lifetime totals, shared with the other workers in sharded mode
+        self.spent_tokens = 0
+
+    async def acquire(self, priority, tokens=0):
+        """Waits until the call fits in the budget. Raises GovernorQueueFull if the queue is full."""
+        now = time.monotonic()
+        self._refill(now)
+        if not self.waiters and self._fits(priority, tokens, now):
+            self._take(tokens)
+            return
+        if len(self.waiters) >= self.max_waiters and priority != PRIORITY_CONTROL:
+            raise GovernorQueueFull()
+        future = asyncio.get_running_loop().create_future()
+        entry = [priority, next(self.seq), tokens, future]
+        heapq.heappush(self.waiters, entry)
+        if now - self.last_report > 10:
+            self.last_report = now
+            log.info(f"[Governor] Waiting for OpenAI budget: {self.snapshot()}")
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if entry in self.waiters:
+                self.waiters.remove(entry)
+                heapq.heapify(self.waiters)
+            elif future.done() and not future.cancelled():
+                # We were admitted but won't use it; give the budget back
+                self.requests.level += 1
+                self.tokens.level += tokens
+                self.spent_requests -= 1
+                self.spent_tokens -= tokens
+            raise
+
+    def observe(self, status_code, headers):
+        """Updates the buckets from an OpenAI response's headers."""
+        now = time.monotonic()
+        limit = headers.get('x-ratelimit-limit-requests')
+        remaining = headers.get('x-ratelimit-remaining-requests')
+        if limit or remaining:
+            self.requests.sync(_header_number(limit), _header_number(remaining), now)
+        limit = headers.get('x-ratelimit-limit-tokens')
+        remaining = headers.get('x-ratelimit-remaining-tokens')
+        if limit or remaining:
+            self.tokens.sync(_header_number(limit), _header_number(remaining), now)
+        if status_code == 429:
+            delay = _retry_after_seconds(headers) or _parse_reset_duration(headers.get('x-ratelimit-reset-requests')) or 1.0
+            log.warning(f"[Governor] OpenAI returned 429, holding new calls for {delay:.1f}s.")
+            self.blocked_until = max(self.blocked_until, now + delay)
+        if self.waiters:
+            self._dispatch()
+
+    def absorb(self, requests, tokens, blocked_until=0.0):
+        """
+        Charges budget spent by other worker processes against our buckets.
+        blocked_until is wall-clock time, since monotonic clocks aren't comparable across processes.
+        """
+        now = time.monotonic()
+        self._refill(now)
+        self.requests.level -= requests
+        self.tokens.level -= tokens
+        blocked_for = blocked_until - time.time()
+        if blocked_for > 0:
+            self.blocked_until = max(self.blocked_until, now + blocked_for)
+        if self.waiters:
+            self._dispatch()
+
+    def snapshot(self):
+        """Current fill levels, for logging and tuning."""
+        self._refill(time.monotonic())
+        return {
+            'requests_available': round(self.requests.level, 1),
+            'requests_per_min': self.requests.capacity,
+            'tokens_available': round(self.tokens.level),
+            'tokens_per_min': self.tokens.capacity,
+            'waiting': len(self.waiters),
+            'blocked_for': round(max(0.0, self.blocked_until - time.monotonic()), 1),
+        }
+
+    def _refill(self, now):
+        self.requests.refill(now)
+        self.tokens.refill(now)
+
+    def _reserve(self, priority):
+        return 0 if priority == PRIORITY_CONTROL else GOVERNOR_CONTROL_RESERVE
+
+    def _tokens_needed(self, priority, tokens):
+        """
+        Token level a call waits for. An estimate bigger than the share of the bucket its lane
+        may use could never fit and would hold up everyone queued behind it, so it only waits
+        for that whole share (and is still charged its full estimate).
+        """
+        reserve = self._reserve(priority)
+        return min(tokens, (1 - reserve) * self.tokens.capacity) + reserve * self.tokens.capacity
+
+    def _fits(self, priority, tokens, now):
+        if now < self.blocked_until:
+            return False
+        reserve = self._reserve(priority)
+        return (self.requests.level >= 1 + reserve * self.requests.capacity
+                and self.tokens.level >= self._tokens_needed(priority, tokens))
+
+    def _take(self, tokens):
+        self.requests.level -= 1
+        self.tokens.level -= tokens
+        self.spent_requests += 1
+        self.spent_tokens += tokens
+
+    def _dispatch(self):
+        """Admits waiters in priority order and schedules a wakeup for the next one."""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        now = time.monotonic()
+        self._refill(now)
+        while self.waiters:
+            priority, _, tokens, future = self.waiters[0]
+            if future.done():
+                heapq.heappop(self.waiters)
+                continue
+            if not self._fits(priority, tokens, now):
+                reserve = self._reserve(priority)
+                delay = max(
+                    self.blocked_until - now,
+                    self.requests.seconds_until(1 + reserve * self.requests.capacity),
+                    self.tokens.seconds_until(self._tokens_needed(priority, tokens)),
+                    0.05,
+                )
+                self.timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+                return
+            heapq.heappop(self.waiters)
+            self._take(tokens)
+            future.set_result(None)
+
+
+def _parse_reset_duration(value):
+    """Parses OpenAI reset headers like '1s', '250ms' or '6m0s' into seconds."""
+    if not value:
+        return 0.0
+    seconds = 0.0
+    for amount, unit in re.findall(r"([\d.]+)(ms|h|m|s)", value):
+        seconds += float(amount) * {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}[unit]
+    return seconds
+
+
+def _retry_after_seconds(headers):
+    """Reads Retry-After style headers from a response, in seconds."""
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        if headers.get('retry-after'):
+            return float(headers['retry-after'])
+    except ValueError:
+        pass
+    return 0.0
+
+
+def _header_number(value):
     try:
-        assistant = client_openai.beta.assistants.retrieve(ASSISTANT_ID)
-        print(f"Successfully connected to Assistant: {assistant.name} ({ASSISTANT_ID})")
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def estimate_tokens(text):
+    """Very rough token estimate (~4 characters per token)."""
+    return len(text) // 4 + 1
+
+
+async def call_openai(priority, request, *args, tokens=0, **kwargs):
+    """
+    Calls an OpenAI client method once the governor admits it. The client itself never retries;
+    429s, 5xx and connection errors are retried here, each attempt going through the governor
+    again so it waits out any 429 back-off and counts against the budget.
+    """
+    for attempt in range(OPENAI_MAX_RETRIES + 1):
+        await openai_governor.acquire(priority, tokens)
+        try:
+            return await request(*args, **kwargs)
+        except (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError) as e:
+            if attempt == OPENAI_MAX_RETRIES or getattr(e, "code", None) == "insufficient_quota":
+                raise
+            delay = 0 if isinstance(e, openai.RateLimitError) else 0.5 * 2 ** attempt * random.uniform(0.8, 1.2)
+            log.warning(f"[Governor] OpenAI call failed ({type(e).__name__}), retrying ({attempt + 1}/{OPENAI_MAX_RETRIES}).")
+            await asyncio.sleep(delay) # A 429 has already set the governor's back-off
+
+
+openai_governor = OpenAIGovernor(OPENAI_REQUESTS_PER_MIN, OPENAI_TOKENS_PER_MIN, GOVERNOR_MAX_WAITERS)
+
+
+# --- Metrics ---
+metrics = Metrics()
+metrics.histogram("keith_stage_seconds", "Time spent in each stage of answering a prompt.")
+metrics.histogram("keith_reply_seconds", "Time from receiving a prompt to finishing the reply.")
+metrics.histogram("keith_first_token_seconds", "Streaming mode: time from receiving a prompt to the first visible token.")
+metrics.counter("keith_run_status_total", "Runs by terminal status, including local timeouts.")
+metrics.gauge("keith_runs_in_flight", "Runs currently in flight, per channel.")
+metrics.histogram("keith_run_seconds", "Assistants run duration from creation to a terminal status, by thread compaction.")
+metrics.counter("keith_thread_compactions_total", "Thread compactions applied, by kind.")
+metrics.counter("keith_run_cancellations_total", "Runs cancelled before they finished, by reason.")
+metrics.counter("keith_resumed_runs_total", "Runs left unfinished by a previous process, by what became of them.")
+metrics.gauge("keith_ready_seconds", "Seconds from process start to the first Discord gateway ready.")
+GOVERNOR_GAUGES = {
+    'requests_available': "Request budget currently available.",
+    'requests_per_min': "Request budget per minute (learned from OpenAI headers).",
+    'tokens_available': "Estimated-token budget currently available.",
+    'tokens_per_min': "Estimated-token budget per minute (learned from OpenAI headers).",
+    'waiting': "OpenAI calls waiting for budget.",
+    'blocked_for': "Seconds left before calls may go out again after a 429.",
+}
+for _name, _help in GOVERNOR_GAUGES.items():
+    metrics.gauge(f"keith_governor_{_name}", _help)
+
+
+def _collect_governor_metrics():
+    for name, value in openai_governor.snapshot().items():
+        metrics.set(f"keith_governor_{name}", value)
+
+metrics.add_collector(_collect_governor_metrics)
+
+OUTBOUND_GAUGES = {
+    'waiting': "Discord sends/edits queued behind another one in their channel.",
+    'channels': "Channels with an outbound queue.",
+    'rate_limited': "429s from Discord that got past the pacing, since startup.",
+}
+for _name, _help in OUTBOUND_GAUGES.items():
+    metrics.gauge(f"keith_outbound_{_name}", _help)
+
+
+def _collect_outbound_metrics():
+    for name, value in outbound.snapshot().items():
+        metrics.set(f"keith_outbound_{name}", value)
+
+metrics.add_collector(_collect_outbound_metrics)
+
+
+class RunStageTimer:
+    """
+    Splits a run's lifetime into queued and in_progress time as its status changes are seen.
+    The whole run is also observed under the compaction applied to its thread.
+    """
+
+    def __init__(self, compaction="none"):
+        self.created_at = time.monotonic()
+        self.started_at = None
+        self.finished = False
+        self.compaction = compaction
+
+    def saw(self, status):
+        if status == 'queued' or self.finished:
+            return
+        now = time.monotonic()
+        if self.started_at is None:
+            self.started_at = now
+            metrics.observe("keith_stage_seconds", now - self.created_at, stage="run_queued")
+        if status not in PENDING_RUN_STATUSES:
+            self.finished = True
+            metrics.observe("keith_stage_seconds", now - self.started_at, stage="run_in_progress")
+            metrics.observe("keith_run_seconds", now - self.created_at, compaction=self.compaction)
+            metrics.inc("keith_run_status_total", status=status)
+
+
+# --- Run Poller ---
+PENDING_RUN_STATUSES = ('queued', 'in_progress', 'cancelling')
+
+
+class RunTimeoutError(Exception):
+    """Raised when a run doesn't finish within RUN_TIMEOUT (the run has been cancelled)."""
+
+
+class _PendingRun:
+    def __init__(self, thread_id, run_id, channel_id, compaction, timeout):
+        self.thread_id = thread_id
+        self.run_id = run_id
+        self.channel_id = channel_id
+        self.timeout = timeout
+        self.started_at = time.monotonic()
+        self.interval = POLL_INITIAL_INTERVAL
+        self.next_poll = self.started_at + POLL_INITIAL_INTERVAL
+        self.stages = RunStageTimer(compaction)
+        self.future = asyncio.get_running_loop().create_future()
+        self.poll_task = None # The poll in flight for this run, if any
+
+
+class RunPoller:
+    """
+    Tracks every in-flight run and polls them all from a single background task, which starts
+    each poll as its own task so a slow request never holds up the other runs.
+    Intervals back off per run, and the whole poller pauses when OpenAI answers a poll with a 429.
+    Polls go through the governor's control lane, which handles the x-ratelimit-* budget.
+    Callers just await wait(), which resolves with the finished run.
+    """
+
+    def __init__(self):
+        self.pending = {} # run_id -> _PendingRun
+        self.paused_until = 0.0
+        self.task = None
+        self.wakeup = None
+
+    async def wait(self, thread_id, run, channel_id, compaction="none", timeout=RUN_TIMEOUT):
+        """
+        Waits for a run to leave queued/in_progress and returns it.
+        Raises RunTimeoutError after `timeout` seconds, openai.NotFoundError if the run/thread disappears.
+        """
+        if run.status not in PENDING_RUN_STATUSES:
+            return run
+        pending = _PendingRun(thread_id, run.id, channel_id, compaction, timeout)
+        self.pending[run.id] = pending
+        if self.wakeup is None:
+            self.wakeup = asyncio.Event()
+        self.wakeup.set()
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._poll_loop())
+        try:
+            return await pending.future
+        finally:
+            self.pending.pop(run.id, None)
+            if pending.poll_task is not None:
+                pending.poll_task.cancel()
+
+    async def cancel_run(self, thread_id, run_id, channel_id, reason):
+        """
+        Asks OpenAI to cancel a run and counts it under `reason`.
+        Returns the run as of the cancel request, or None. Errors are logged, not raised.
+        """
+        metrics.inc("keith_run_cancellations_total", reason=reason)
+        try:
+            log.info(f"[Channel {channel_id}] Attempting to cancel run {run_id} ({reason})...")
+            run = await call_openai(PRIORITY_CONTROL, client_openai.beta.threads.runs.cancel, thread_id=thread_id, run_id=run_id)
+            log.info(f"[Channel {channel_id}] Cancel request sent for run {run_id}.")
+            return run
+        except Exception as cancel_err:
+            log.error(f"[Channel {channel_id}] Error attempting to cancel run {run_id}: {cancel_err}")
+            return None
+
+    async def _poll_loop(self):
+        while self.pending:
+            now = time.monotonic()
+            idle = [p for p in self.pending.values() if p.poll_task is None and not p.future.done()]
+            next_poll = min((p.next_poll for p in idle), default=None)
+            wake_at = None if next_poll is None else max(self.paused_until, next_poll)
+            if wake_at is None or wake_at > now:
+                self.wakeup.clear()
+                try:
+                    # A finished poll or a new run sets wakeup
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=None if wake_at is None else wake_at - now)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            for pending in idle:
+                if pending.next_poll <= now:
+                    pending.poll_task = asyncio.create_task(self._poll(pending))
+                    pending.poll_task.add_done_callback(lambda task, pending=pending: self._poll_done(pending, task))
+
+    def _poll_done(self, pending, task):
+        pending.poll_task = None
+        if not task.cancelled() and task.exception() is not None:
+            log.error(f"[Channel {pending.channel_id}] Polling run {pending.run_id} failed: {task.exception()}")
+            self._resolve(pending, error=task.exception())
+        self.wakeup.set()
+
+    async def _poll(self, pending):
+        now = time.monotonic()
+        if now - pending.started_at > pending.timeout:
+            log.warning(f"[Channel {pending.channel_id}] Run {pending.run_id} timed out.")
+            metrics.inc("keith_run_status_total", status="timeout")
+            await self.cancel_run(pending.thread_id, pending.run_id, pending.channel_id, "timeout")
+            self._resolve(pending, error=RunTimeoutError(pending.run_id))
+            return
+        try:
+            run = await asyncio.wait_for(call_openai(
+                PRIORITY_CONTROL, client_openai.beta.threads.runs.retrieve,
+                thread_id=pending.thread_id, run_id=pending.run_id,
+            ), timeout=POLL_REQUEST_TIMEOUT)
+        except openai.NotFoundError as e:
+            log.error(f"[Channel {pending.channel_id}] Error polling run {pending.run_id}: Run or Thread not found.")
+            self._resolve(pending, error=e)
+            return
+        except openai.RateLimitError as e:
+            delay = _retry_after_seconds(e.response.headers) or POLL_MAX_INTERVAL
+            log.warning(f"[Run Poller] Rate limited while polling, pausing all polls for {delay:.1f}s.")
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+            return
+        except asyncio.TimeoutError:
+            log.warning(f"[Channel {pending.channel_id}] Polling run {pending.run_id} took over {POLL_REQUEST_TIMEOUT}s, retrying.")
+            pending.next_poll = time.monotonic() + 3
+            return
+        except Exception as poll_err:
+            log.error(f"[Channel {pending.channel_id}] Error polling run {pending.run_id}: {poll_err}")
+            pending.next_poll = time.monotonic() + 3
+            return
+
+        pending.stages.saw(run.status)
+        if run.status not in PENDING_RUN_STATUSES:
+            log.info(f"[Channel {pending.channel_id}] Run status: {run.status}")
+            self._resolve(pending, run=run)
+            return
+        pending.interval = min(pending.interval * POLL_BACKOFF, POLL_MAX_INTERVAL)
+        jitter = random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
+        pending.next_poll = time.monotonic() + pending.interval * jitter
+
+    def _resolve(self, pending, run=None, error=None):
+        self.pending.pop(pending.run_id, None)
+        if pending.future.done():
+            return
+        if error is not None:
+            pending.future.set_exception(error)
+        else:
+            pending.future.set_result(run)
+
+
+run_poller = RunPoller()
+
+
+async def load_assistant():
+    """
+    Looks up the Assistant once per process. The result is cached in assistant_profile (the chat
+    backend's default model and instructions); the task's result is the Assistant, or None.
+    """
+    global assistant_profile
+    try:
+        assistant_profile = await call_openai(PRIORITY_NORMAL, client_openai.beta.assistants.retrieve, ASSISTANT_ID)
+        log.info(f"Successfully connected to Assistant: {assistant_profile.name} ({ASSISTANT_ID})")
     except openai.NotFoundError:
-        print(f"ERROR: Assistant with ID '{ASSISTANT_ID}' not found. Check the ID.")
-        # You might want to exit() here or handle it differently idk
+        log.error(f"Assistant with ID '{ASSISTANT_ID}' not found. Check the ID.")
     except openai.AuthenticationError:
-         print("ERROR: OpenAI Authentication Failed. Check your API Key.")
-         # exit()
+        log.error("OpenAI Authentication Failed. Check your API Key.")
     except Exception as e:
-        print(f"ERROR: Could not retrieve Assistant {ASSISTANT_ID}: {e}")
-        # exit()
+        log.error(f"Could not retrieve Assistant {ASSISTANT_ID}: {e}")
+    return assistant_profile
+
+
+async def assistant_ready():
+    """Waits for the startup Assistant lookup if it is still running. Returns the Assistant or None."""
+    task = background_tasks.get("assistant")
+    if task is not None and not task.done():
+        await asyncio.shield(task) # A cancelled reply mustn't cancel the lookup
+    return assistant_profile
+
 
-    print(f'Bot is ready and listening for "Keith..." commands using Assistant ID: {ASSISTANT_ID}')
+async def report_startup():
+    """--check: reports the cold-start timings and the Assistant lookup, then disconnects."""
+    global check_passed
+    ready_at = startup_times["ready"]
+    log.info(f"[Check] Imports and setup: {startup_times['main'] - STARTED_AT:.2f}s")
+    log.info(f"[Check] Discord login and gateway: {ready_at - startup_times['connect']:.2f}s")
+    log.info(f"[Check] Cold start to first gateway ready: {ready_at - STARTED_AT:.2f}s")
+    check_passed = True
+    if ASSISTANT_ID:
+        check_passed = await assistant_ready() is not None
+        outcome = "ok" if check_passed else "FAILED"
+        log.info(f"[Check] Assistant lookup: {outcome}, done {time.perf_counter() - ready_at:.2f}s after ready")
+    await client_discord.close()
 
-    if TKINTER_AVAILABLE:
-        print(f'Listening for "HalcM" command from User ID {ALLOWED_USER_ID} to trigger local input loop.')
-        # Start the background task that processes the message queue
-        asyncio.create_task(check_message_queue())
+
+@client_discord.event
+async def on_ready():
+    global metrics_server
+    first_ready = "ready" not in startup_times
+    if first_ready:
+        startup_times["ready"] = time.perf_counter()
+        metrics.set("keith_ready_seconds", startup_times["ready"] - STARTED_AT)
+        log.info(f"Logged in as {client_discord.user}, {startup_times['ready'] - STARTED_AT:.2f}s after start")
     else:
-        print('HalcM command disabled (tkinter not found).')
+        log.info(f"Logged in as {client_discord.user} again after a reconnect")
+    if worker_index is not None:
+        log.info(f"Worker {worker_index} serving shards {client_discord.shard_ids} of {client_discord.shard_count}.")
+    # Validated in the background, so Keith answers right away; the chat backend waits if it must
+    if ASSISTANT_ID:
+        start_background("assistant", load_assistant, once=True)
+    if check_mode:
+        start_background("check", report_startup, once=True)
+        return
+    thread_store.start()
+    start_background("resume", resume_journaled_runs, once=True) # Once per process, not on every reconnect
+    if shared_limits is not None:
+        shared_limits.start(openai_governor)
+    metrics_port = METRICS_PORT + (worker_index or 0) if METRICS_PORT else None
+    if metrics_port and metrics_server is None:
+        try:
+            metrics_server = await metrics.serve(METRICS_HOST, metrics_port)
+        except OSError as e:
+            log.error(f"Could not start metrics endpoint on {METRICS_HOST}:{metrics_port}: {e}")
+    if not first_ready:
+        return
+
+    log.info(f'Bot is ready and listening for "Keith..." commands using the "{BACKEND}" backend (Assistant ID: {ASSISTANT_ID})')
+    if CHANNEL_BACKENDS:
+        log.info(f"Per-channel backend overrides: {CHANNEL_BACKENDS}")
+
+    if manual_input_available():
+        log.info(f'Listening for "HalcM" command from User ID {ALLOWED_USER_ID} to trigger local input loop ({MANUAL_INPUT_SOURCE}).')
+    elif MANUAL_INPUT_SOURCE == "tk":
+        log.info('HalcM command disabled (tkinter not found).')
+    else:
+        log.info(f'HalcM command disabled (input source "{MANUAL_INPUT_SOURCE}" not available).')
 
-    print('------')
 
 
 @client_discord.event
@@ -174,42 +1164,47 @@ async def on_message(message):
     # Need access to modify these from within the function if HalcM is triggered
     global manual_mode_active, manual_mode_channel_id
 
-    if message.author == client_discord.user:
+    if message.author == client_discord.user or check_mode:
         return
 
 
     # --- Added HalcM Trigger Check ---
     # Check for HalcM command *before* the Keith command check
     if message.content.lower() == 'halcm' and message.author.id == ALLOWED_USER_ID:
-        if not TKINTER_AVAILABLE:
+        # tkinter is imported on the first HalcM, off the event loop
+        if not manual_input_available() or (MANUAL_INPUT_SOURCE == "tk" and await asyncio.to_thread(load_tkinter) is None):
             try:
-                await message.channel.send("Sorry, the local input feature requires `tkinter` which was not found.", delete_after=10)
+                if MANUAL_INPUT_SOURCE == "tk":
+                    await outbound.post(message.channel, "Sorry, the local input feature requires `tkinter` which was not found.", delete_after=10)
+                else:
+                    await outbound.post(message.channel, f"Sorry, the `{MANUAL_INPUT_SOURCE}` manual input isn't available here.", delete_after=10)
                 await message.delete()
             except Exception: pass
             return
 
         with manual_mode_lock: # Safely check and set state
             if manual_mode_active:
-                print(f"User {message.author.id} tried HalcM, but already active for channel {manual_mode_channel_id}.")
+                log.info(f"User {message.author.id} tried HalcM, but already active for channel {manual_mode_channel_id}.")
                 try:
-                    await message.channel.send(f"Manual mode is already active (controlling channel <#{manual_mode_channel_id}>). Type `stop` in the local popup to exit.", delete_after=15)
+                    await outbound.post(message.channel, f"Manual mode is already active (controlling channel <#{manual_mode_channel_id}>). Type `stop` in the local popup to exit.", delete_after=15)
                     await message.delete()
                 except Exception: pass
                 return
 
-            print(f"Activating manual control mode for channel {message.channel.id} by user {message.author.id}")
+            log.info(f"Activating manual control mode for channel {message.channel.id} by user {message.author.id}")
             manual_mode_active = True
             manual_mode_channel_id = message.channel.id
 
         try: # Delete trigger message outside lock
             await message.delete()
-            print(f"Deleted trigger message for HalcM.")
+            log.info(f"Deleted trigger message for HalcM.")
         except Exception as e:
-            print(f"Could not delete trigger message for HalcM: {e}")
+            log.info(f"Could not delete trigger message for HalcM: {e}")
 
-        # Start the GUI input loop in a separate thread
+        # Start the input loop in a separate thread, feeding the sender task on this loop
+        ensure_manual_sender()
         gui_thread = threading.Thread(target=run_manual_input_loop,
-                                      args=(message.channel.id,),
+                                      args=(message.channel.id, asyncio.get_running_loop()),
                                       daemon=True)
         gui_thread.start()
 
@@ -220,190 +1215,1144 @@ async def on_message(message):
         if manual_mode_active and message.channel.id == manual_mode_channel_id:
             # Don't process 'Keith' or other commands if manual mode is active in this channel
             # We already checked for the HalcM trigger itself above.
-            print(f"Ignoring message from {message.author} in channel {message.channel.id} (manual mode active).")
+            log.info(f"Ignoring message from {message.author} in channel {message.channel.id} (manual mode active).")
+            return
+
+    # Assistant ID is checked on startup, so we assume it's valid here
+    user_prompt = parse_keith_prompt(message.content)
+    if user_prompt:
+        await enqueue_prompt(message, user_prompt)
+
+
+@client_discord.event
+async def on_raw_message_delete(payload):
+    # Raw events also cover messages that dropped out of discord.py's message cache
+    await supersede_prompt(payload.channel_id, payload.message_id, None, "deleted")
+
+
+@client_discord.event
+async def on_raw_message_edit(payload):
+    content = payload.data.get("content")
+    if content is None:
+        return # Embed/attachment update, the text didn't change
+    await supersede_prompt(payload.channel_id, payload.message_id, parse_keith_prompt(content), "edited")
+
+
+def parse_keith_prompt(content):
+    """Returns the prompt after the "Keith" trigger, or None if this isn't a Keith message."""
+    trigger_phrase = "Keith"
+    if not content.lower().startswith(trigger_phrase.lower()):
+        return None
+    # "Keith" on its own isn't a prompt (we used to answer "Hi! You need to ask me something after 'Keith'.")
+    return content[len(trigger_phrase):].strip() or None
+
+
+# --- Per-Channel Prompt Queue ---
+class QueuedPrompt:
+    def __init__(self, message, user_prompt):
+        self.message = message
+        self.user_prompt = user_prompt
+        self.received_at = time.monotonic()
+
+
+async def enqueue_prompt(message, user_prompt):
+    """Buffers a prompt for its channel and makes sure the channel has a worker answering it."""
+    channel_id = message.channel.id
+    pending = channel_queues.setdefault(channel_id, [])
+    if len(pending) >= MAX_CHANNEL_QUEUE_DEPTH:
+        log.warning(f"[Channel {channel_id}] Queue full ({len(pending)} prompts), turning away prompt from {message.author}.")
+        try:
+            await outbound.post(message.channel, "I'm still catching up on this channel, try again in a moment.",
+                                reference=message, mention_author=False)
+        except Exception: pass
+        return
+    pending.append(QueuedPrompt(message, user_prompt))
+    if channel_id in channel_workers:
+        log.info(f"[Channel {channel_id}] Run in progress, buffered prompt from {message.author} ({len(pending)} waiting).")
+    if channel_id not in channel_workers:
+        channel_workers[channel_id] = asyncio.create_task(channel_worker(channel_id))
+
+
+class ActiveReply:
+    """
+    A batch of prompts a channel worker is answering right now. The backend attaches its
+    RunTracker and StreamingReply so an edit or delete can cancel the whole thing.
+    """
+
+    def __init__(self, channel_id, batch):
+        self.channel_id = channel_id
+        self.batch = batch
+        self.task = None
+        self.tracker = None
+        self.reply = None
+        self.cancel_reason = None
+        self.settled = asyncio.Event() # Set once a cancelled run is really gone on OpenAI's side
+
+
+async def channel_worker(channel_id):
+    """Answers a channel's queued prompts one run at a time, coalescing bursts into one run."""
+    first = True
+    try:
+        while channel_queues.get(channel_id):
+            if not first:
+                # Give a burst a moment to finish arriving so it gets answered by one run
+                while pending := channel_queues.get(channel_id):
+                    quiet_for = time.monotonic() - pending[-1].received_at
+                    if quiet_for >= COALESCE_WINDOW:
+                        break
+                    await asyncio.sleep(COALESCE_WINDOW - quiet_for)
+                if not pending:
+                    continue # Everything that was waiting got deleted meanwhile
+            first = False
+            batch = channel_queues.pop(channel_id)
+            if len(batch) == 1:
+                user_prompt = batch[0].user_prompt
+            else:
+                log.info(f"[Channel {channel_id}] Coalescing {len(batch)} prompts into one run.")
+                user_prompt = "\n\n".join(f"{q.message.author.display_name}: {q.user_prompt}" for q in batch)
+            active = ActiveReply(channel_id, batch)
+            for queued in batch:
+                active_replies[queued.message.id] = active
+            try:
+                # Wait for a free slot so a burst of prompts can't flood the API
+                async with run_semaphore:
+                    if active.cancel_reason is None:
+                        active.task = asyncio.create_task(
+                            backend_for(channel_id).respond(batch[-1].message, user_prompt, batch[0].received_at)
+                        )
+                        await active.task
+            except asyncio.CancelledError:
+                if active.cancel_reason is None:
+                    raise # Shutting down
+            except Exception as e:
+                log.error(f"[Channel {channel_id}] Unexpected error answering queued prompts: {e}")
+            finally:
+                for queued in batch:
+                    if active_replies.get(queued.message.id) is active:
+                        del active_replies[queued.message.id]
+            if active.cancel_reason is not None:
+                # The thread can't take the next prompt while the cancelled run is still winding down
+                await active.settled.wait()
+    finally:
+        channel_workers.pop(channel_id, None)
+
+
+async def supersede_prompt(channel_id, message_id, new_prompt, reason):
+    """
+    Handles a Keith message being edited (new_prompt is the corrected prompt) or deleted
+    or edited into something that isn't a prompt (new_prompt is None).
+    A prompt still waiting in the queue is updated or dropped in place. If it is already
+    being answered, that run is cancelled and the batch goes back to the front of the queue.
+    """
+    pending = channel_queues.get(channel_id, [])
+    for queued in pending:
+        if queued.message.id == message_id:
+            if new_prompt is None:
+                pending.remove(queued)
+                if not pending:
+                    channel_queues.pop(channel_id, None)
+                log.info(f"[Channel {channel_id}] Dropped queued prompt {message_id} ({reason}).")
+            elif new_prompt != queued.user_prompt:
+                queued.user_prompt = new_prompt
+                log.info(f"[Channel {channel_id}] Updated queued prompt {message_id} ({reason}).")
             return
+    active = active_replies.get(message_id)
+    if active is None or active.cancel_reason is not None:
+        return
+    remaining = []
+    for queued in active.batch:
+        if queued.message.id == message_id:
+            if new_prompt is None:
+                continue
+            if new_prompt == queued.user_prompt:
+                return # Only an embed or the like changed
+            queued.user_prompt = new_prompt
+        remaining.append(queued)
+    log.info(f"[Channel {channel_id}] Prompt {message_id} was {reason} while being answered, cancelling its run.")
+    if remaining:
+        channel_queues[channel_id] = remaining + channel_queues.get(channel_id, [])
+        if channel_id not in channel_workers:
+            channel_workers[channel_id] = asyncio.create_task(channel_worker(channel_id))
+    await cancel_active_reply(active, reason)
+
+
+async def cancel_active_reply(active, reason):
+    """
+    The single path for cancelling a reply early. Stops the reply task (which frees its
+    concurrency slot at once), cancels the OpenAI run (found by listing the thread's runs
+    if its create call was cut off), removes its journal entry, its prompt and partial
+    answer from the thread and any half-streamed reply, and counts the cancellation under `reason`.
+    """
+    if active.cancel_reason is not None:
+        return
+    active.cancel_reason = reason
+    if active.task is not None:
+        active.task.cancel()
+    try:
+        tracker = active.tracker
+        run_ids = []
+        if tracker is not None and tracker.run_requested:
+            if tracker.run_id is None:
+                await asyncio.wait([active.task]) # Let a create call that was in flight return or fail
+            if tracker.run_id is not None:
+                run_ids = [tracker.run_id]
+            else:
+                # Cancelled mid-request, so we never got the run's ID, but OpenAI may still have started it
+                run_ids = await find_active_runs(tracker.thread_id, active.channel_id)
+        runs = [await run_poller.cancel_run(tracker.thread_id, run_id, active.channel_id, reason) for run_id in run_ids]
+        if not run_ids:
+            metrics.inc("keith_run_cancellations_total", reason=reason) # No OpenAI run yet (or chat backend)
+        if tracker is not None:
+            await tracker.done()
+        for run in runs:
+            if run is not None:
+                try:
+                    await run_poller.wait(tracker.thread_id, run, active.channel_id, timeout=RUN_CANCEL_TIMEOUT)
+                except Exception:
+                    pass # Gone, or stuck cancelling; either way we've waited long enough
+        if tracker is not None:
+            await remove_superseded_messages(tracker, run_ids, active.channel_id)
+        if active.reply is not None:
+            await active.reply.delete()
+    except Exception as e:
+        log.error(f"[Channel {active.channel_id}] Error cleaning up a cancelled reply: {e}")
+    finally:
+        active.settled.set()
+
+
+async def find_active_runs(thread_id, channel_id):
+    """
+    IDs of the queued or in-progress runs on a thread. OpenAI may get round to creating a
+    run whose request we abandoned a moment later, so this looks a few times before giving up.
+    """
+    for attempt in range(ORPHAN_RUN_LOOKUPS):
+        if attempt:
+            await asyncio.sleep(1)
+        try:
+            runs = await call_openai(PRIORITY_CONTROL, client_openai.beta.threads.runs.list,
+                                     thread_id=thread_id, order='desc', limit=5)
+        except Exception as e:
+            log.error(f"[Channel {channel_id}] Couldn't list the runs on thread {thread_id}: {e}")
+            return []
+        run_ids = [run.id for run in runs.data if run.status in ('queued', 'in_progress')]
+        if run_ids:
+            return run_ids
+    return []
 
-    if message.content.lower().startswith('keith'):
-        # Assistant ID is checked on startup, so we assume it's valid here
-        # if not ASSISTANT_ID: # This check is redundant now but harmless
-        #      await message.channel.send("Sorry, the Assistant ID is not configured correctly.")
-        #      return
 
-        trigger_phrase = "Keith"
+async def remove_superseded_messages(tracker, run_ids, channel_id):
+    """Deletes a cancelled reply's prompt and any partial answer from the thread, so they don't linger in its context."""
+    message_ids = [tracker.prompt_message_id] if tracker.prompt_message_id else []
+    if run_ids:
         try:
-            start_index = message.content.lower().index(trigger_phrase.lower())
-            user_prompt = message.content[start_index + len(trigger_phrase):].strip()
-        except ValueError:
-            return # Should not happen if startswith passed
+            messages = await call_openai(PRIORITY_CONTROL, client_openai.beta.threads.messages.list,
+                                         thread_id=tracker.thread_id, order='desc', limit=10)
+            message_ids += [msg.id for msg in messages.data if msg.run_id in run_ids]
+        except Exception as e:
+            log.error(f"[Channel {channel_id}] Couldn't list thread {tracker.thread_id} to remove a cancelled answer: {e}")
+    for message_id in message_ids:
+        try:
+            await call_openai(PRIORITY_CONTROL, client_openai.beta.threads.messages.delete,
+                              message_id, thread_id=tracker.thread_id)
+        except Exception as e:
+            log.error(f"[Channel {channel_id}] Couldn't remove message {message_id} from thread {tracker.thread_id}: {e}")
+
 
-        if not user_prompt:
-            # await message.channel.send("Hi! You need to ask me something after 'Keith'.")
+def run_error_message(run):
+    """Builds the user-facing message for a run that ended without completing."""
+    error_message = f"Sorry, the process ended with status: {run.status}."
+    if run.last_error:
+        error_message += f" Error Code: {run.last_error.code}. Message: {run.last_error.message}"
+    return error_message[:1950]
+
+
+class StreamingReply:
+    """
+    Shows an Assistant reply while it is being generated by editing Discord messages in place.
+    The first text replaces the placeholder as soon as it arrives; later edits are throttled
+    to STREAM_EDIT_INTERVAL and roll over into new messages past 2000 chars.
+    Replies that grow past ATTACH_REPLIES_OVER stop updating and end up as a preview plus file.
+    """
+
+    def __init__(self, channel, received_at):
+        self.channel = channel
+        self.received_at = received_at
+        self.text = ""
+        self.messages = [] # Discord messages posted for this reply, in order
+        self.last_edit = 0.0
+        self.first_token_shown = False
+
+    async def start(self):
+        self.messages.append(await outbound.post(self.channel, STREAM_PLACEHOLDER))
+        self.last_edit = time.monotonic()
+
+    async def add(self, delta):
+        self.text += delta
+        if not self.first_token_shown or time.monotonic() - self.last_edit >= STREAM_EDIT_INTERVAL:
+            await self.flush()
+
+    async def flush(self):
+        if len(self.text) > ATTACH_REPLIES_OVER and self.first_token_shown:
+            self.last_edit = time.monotonic()
+            return # Becomes an attachment in finish()
+        parts = chunk_message(self.text, DISCORD_MESSAGE_LIMIT)
+        if not parts:
             return
+        for i, part in enumerate(parts):
+            if i < len(self.messages):
+                if self.messages[i].content != part:
+                    with metrics.timed("keith_stage_seconds", stage="discord_edit"):
+                        self.messages[i] = await outbound.edit(self.messages[i], content=part)
+            else:
+                with metrics.timed("keith_stage_seconds", stage="discord_send"):
+                    self.messages.append(await outbound.post(self.channel, part))
+        self.last_edit = time.monotonic()
+        if not self.first_token_shown:
+            self.first_token_shown = True
+            metrics.observe("keith_first_token_seconds", self.last_edit - self.received_at)
+            log.info(f"[Channel {self.channel.id}] Time to first visible token: {self.last_edit - self.received_at:.2f}s")
+
+    async def finish(self, fallback_text):
+        """Flushes the remaining text, or shows fallback_text if nothing was generated."""
+        if len(self.text) > ATTACH_REPLIES_OVER:
+            await self.attach()
+        elif self.text.strip():
+            await self.flush()
+        else:
+            self.messages[0] = await outbound.edit(self.messages[0], content=fallback_text)
+
+    async def attach(self):
+        """Replaces the streamed messages with a preview and the whole reply as a file."""
+        log.info(f"[Channel {self.channel.id}] Reply is long ({len(self.text)} chars), sending it as an attachment.")
+        preview, file = outbound.as_attachment(self.text)
+        with metrics.timed("keith_stage_seconds", stage="discord_edit"):
+            self.messages[0] = await outbound.edit(self.messages[0], content=preview, attachments=[file])
+        for posted in self.messages[1:]:
+            try: await posted.delete()
+            except Exception: pass
+        del self.messages[1:]
+
+    async def delete(self):
+        """Removes everything posted for this reply (it was cancelled)."""
+        for posted in self.messages:
+            try: await posted.delete()
+            except Exception: pass
+        self.messages = []
+
+    async def discard(self):
+        """Removes the placeholder if nothing was shown yet."""
+        if not self.first_token_shown:
+            try: await self.messages[0].delete()
+            except Exception: pass
+
+
+# --- Thread Compaction ---
+SUMMARY_INSTRUCTIONS = (
+    "Summarize this Discord conversation between users and Keith, a helpful bot, in at most 200 words. "
+    "Keep names, facts, decisions and open questions that later messages may refer to."
+)
+
+
+def compaction_settings(channel_id):
+    """The COMPACT_* thresholds for a channel, with its CHANNEL_COMPACTION overrides applied."""
+    settings = {
+        'truncate_messages': COMPACT_TRUNCATE_MESSAGES,
+        'truncate_tokens': COMPACT_TRUNCATE_TOKENS,
+        'keep_messages': COMPACT_KEEP_MESSAGES,
+        'rollover_messages': COMPACT_ROLLOVER_MESSAGES,
+        'rollover_tokens': COMPACT_ROLLOVER_TOKENS,
+        'summary_messages': COMPACT_SUMMARY_MESSAGES,
+    }
+    settings.update(CHANNEL_COMPACTION.get(channel_id, {}))
+    return settings
+
+
+def plan_compaction(channel_id):
+    """Returns "none", "truncated" or "rolled_over" for a channel's current thread."""
+    settings = compaction_settings(channel_id)
+    message_count, tokens = thread_store.usage(channel_id)
+
+    def over(value, limit):
+        return limit is not None and value >= limit
+
+    if over(message_count, settings['rollover_messages']) or over(tokens, settings['rollover_tokens']):
+        return "rolled_over"
+    if over(message_count, settings['truncate_messages']) or over(tokens, settings['truncate_tokens']):
+        return "truncated"
+    return "none"
+
+
+def message_text(msg):
+    return "".join(block.text.value for block in msg.content or [] if block.type == 'text')
 
-        channel_id = message.channel.id
-        print(f"\n[Channel {channel_id}] Received prompt from {message.author}: '{user_prompt}'")
 
-        # --- Get or Create Thread ---
-        thread_id = channel_threads.get(channel_id)
-        if thread_id is None:
-            print(f"[Channel {channel_id}] Creating new thread...")
+async def roll_over_thread(channel_id, thread_id):
+    """
+    Moves a channel onto a new thread seeded with a summary of the old thread's recent messages.
+    Returns the new thread ID, or None if that failed (the channel keeps its old thread).
+    """
+    settings = compaction_settings(channel_id)
+    log.info(f"[Channel {channel_id}] Thread {thread_id} is large, rolling over to a summarized thread...")
+    try:
+        with metrics.timed("keith_stage_seconds", stage="thread_rollover"):
+            messages = await call_openai(
+                PRIORITY_NORMAL, client_openai.beta.threads.messages.list,
+                thread_id=thread_id,
+                order='desc',
+                limit=max(1, min(100, settings['summary_messages'])),
+            )
+            transcript = "\n".join(
+                f"{'Keith' if msg.role == 'assistant' else 'User'}: {message_text(msg)}"
+                for msg in reversed(messages.data)
+            )
+            completion = await call_openai(
+                PRIORITY_NORMAL, client_openai.chat.completions.create,
+                tokens=estimate_tokens(transcript) + RUN_TOKEN_ESTIMATE,
+                model=COMPACT_SUMMARY_MODEL or BACKENDS["chat"].model(),
+                messages=[{"role": "system", "content": SUMMARY_INSTRUCTIONS}, {"role": "user", "content": transcript}],
+            )
+            summary = (completion.choices[0].message.content or "").strip()
+            if not summary:
+                raise ValueError("the summary came back empty")
+            seed = f"Summary of our conversation so far:\n{summary}"
+            thread = await call_openai(
+                PRIORITY_NORMAL, client_openai.beta.threads.create,
+                messages=[{"role": "assistant", "content": seed}],
+            )
+    except Exception as e:
+        log.warning(f"[Channel {channel_id}] Couldn't roll over thread {thread_id}, truncating instead: {e}")
+        metrics.inc("keith_thread_compactions_total", kind="rollover_failed")
+        return None
+    thread_store.set(channel_id, thread.id, message_count=1, token_estimate=estimate_tokens(seed))
+    metrics.inc("keith_thread_compactions_total", kind="rolled_over")
+    log.info(f"[Channel {channel_id}] Rolled over to thread {thread.id} ({len(summary)} char summary).")
+    return thread.id
+
+
+def record_thread_growth(channel_id, user_prompt, run, compaction):
+    """Updates a thread's size stats after a prompt (and, if the run completed, Keith's reply) went into it."""
+    message_count, tokens = thread_store.usage(channel_id)
+    usage = getattr(run, "usage", None)
+    if usage is not None and compaction != "truncated":
+        tokens = usage.prompt_tokens + usage.completion_tokens # The run read the whole thread
+    elif usage is not None:
+        tokens += estimate_tokens(user_prompt) + usage.completion_tokens
+    else:
+        tokens += estimate_tokens(user_prompt) + RUN_TOKEN_ESTIMATE
+    replied = run is not None and run.status == 'completed'
+    thread_store.record_usage(channel_id, 2 if replied else 1, tokens)
+
+
+class RunTracker:
+    """
+    Journals the run answering a message and guards the delivery of its reply. Also
+    remembers what the reply added to the thread, so a superseded prompt can be undone.
+    """
+
+    def __init__(self, message, thread_id):
+        self.message = message
+        self.thread_id = thread_id
+        self.run_id = None
+        self.journaled = False
+        self.prompt_message_id = None # The prompt's message in the OpenAI thread
+        self.run_requested = False # A run may exist on OpenAI's side even while run_id is None
+
+    async def started(self, run, placeholder_id=None):
+        if self.run_id is not None:
+            return
+        self.run_id = run.id
+        guild = getattr(self.message, "guild", None)
+        try:
+            await run_journal.add(run.id, self.message.channel.id, guild.id if guild else None,
+                                  self.thread_id, self.message.id, placeholder_id)
+            self.journaled = True
+        except Exception as e:
+            log.error(f"[Channel {self.message.channel.id}] Couldn't journal run {run.id}, it won't survive a restart: {e}")
+
+    async def claim(self):
+        """Whether we may post the reply (False if another process already did)."""
+        if not self.journaled:
+            return True
+        try:
+            return await run_journal.claim(self.run_id)
+        except Exception as e:
+            log.error(f"[Channel {self.message.channel.id}] Couldn't claim run {self.run_id} in the journal: {e}")
+            return True
+
+    async def done(self):
+        if self.journaled:
             try:
-                thread = client_openai.beta.threads.create()
-                thread_id = thread.id
-                channel_threads[channel_id] = thread_id
-                print(f"[Channel {channel_id}] Created thread ID: {thread_id}")
+                await run_journal.remove(self.run_id)
             except Exception as e:
-                print(f"Error creating thread: {e}")
-                await message.channel.send("Sorry, I couldn't start a new conversation thread.")
-                return
+                log.error(f"[Channel {self.message.channel.id}] Couldn't remove run {self.run_id} from the journal: {e}")
+
+
+async def fetch_run_reply(thread_id, run_id):
+    """Returns the text of the Assistant's message for a finished run, or None if there isn't one."""
+    with metrics.timed("keith_stage_seconds", stage="messages_list"):
+        messages = await call_openai(
+            PRIORITY_CONTROL, client_openai.beta.threads.messages.list,
+            thread_id=thread_id,
+            order='desc' # Latest messages first
+        )
+    # Find the latest message from the assistant for this run
+    for msg in messages.data:
+        if msg.run_id == run_id and msg.role == 'assistant':
+            return message_text(msg) if msg.content else None
+    return None
+
+
+async def open_run_stream(stack, thread_id, run_options):
+    """Starts a streaming run, closed with `stack`. Safe to retry: the request is only sent on entering."""
+    manager = client_openai.beta.threads.runs.stream(thread_id=thread_id, assistant_id=ASSISTANT_ID, **run_options)
+    return await stack.enter_async_context(manager)
+
+
+async def stream_run(message, thread_id, received_at, tokens, tracker, compaction="none", run_options=None):
+    """
+    Creates a run with the Assistants event stream and edits the reply as text deltas arrive.
+    Returns the last run object seen (None if the stream never reported one).
+    """
+    channel_id = message.channel.id
+    log.info(f"[Channel {channel_id}] Streaming run for thread {thread_id} with assistant {ASSISTANT_ID}...")
+    reply = StreamingReply(message.channel, received_at)
+    active = active_replies.get(message.id)
+    if active is not None:
+        active.reply = reply
+    await reply.start()
+    run = None
+    stages = RunStageTimer(compaction)
+
+    async def consume(stream):
+        nonlocal run
+        async for event in stream:
+            if event.event == 'thread.message.delta':
+                for block in event.data.delta.content or []:
+                    if block.type == 'text' and block.text and block.text.value:
+                        await reply.add(block.text.value)
+            elif event.event.startswith('thread.run.') and not event.event.startswith('thread.run.step'):
+                run = event.data
+                stages.saw(run.status)
+                await tracker.started(run, placeholder_id=reply.messages[0].id)
+
+    try:
+        async with contextlib.AsyncExitStack() as stack:
+            stream = await call_openai(PRIORITY_NEW_RUN, open_run_stream, stack, thread_id, run_options or {}, tokens=tokens)
+            try:
+                await asyncio.wait_for(consume(stream), timeout=RUN_TIMEOUT)
+            except asyncio.TimeoutError:
+                log.warning(f"[Channel {channel_id}] Streaming run timed out.")
+                metrics.inc("keith_run_status_total", status="timeout")
+                if run is not None:
+                    await run_poller.cancel_run(thread_id, run.id, channel_id, "timeout")
+                await reply.finish("Sorry, the request took too long to process.")
+                return run
+    except Exception:
+        await reply.discard()
+        raise
+
+    if run is not None and run.status == 'completed':
+        if not await tracker.claim():
+            log.warning(f"[Channel {channel_id}] Reply for run {run.id} was already delivered elsewhere.")
+            return run
+        await reply.finish("I received an empty response.")
+        log.info(f"[Channel {channel_id}] Streamed response finished ({len(reply.text)} chars).")
+    elif run is not None:
+        log.info(f"[Channel {channel_id}] Run ended with status: {run.status}")
+        if reply.text.strip():
+            await reply.flush()
+            await outbound.post(message.channel, run_error_message(run))
         else:
-            print(f"[Channel {channel_id}] Using existing thread ID: {thread_id}")
+            await reply.finish(run_error_message(run))
+    else:
+        await reply.finish("Sorry, something went wrong (stream ended without a run).")
+    return run
+
+
+async def answer_prompt(message, user_prompt, received_at):
+    """Runs a Keith prompt through the Assistant and replies in the message's channel."""
+    channel_id = message.channel.id
+    log.info(f"[Channel {channel_id}] Received prompt from {message.author}: '{user_prompt}'")
+
+    # --- Get or Create Thread ---
+    thread_id = await thread_store.get(channel_id)
+    if thread_id is None:
+        log.info(f"[Channel {channel_id}] Creating new thread...")
         try:
-            print(f"[Channel {channel_id}] Adding message to thread {thread_id}...")
-            client_openai.beta.threads.messages.create(
+            with metrics.timed("keith_stage_seconds", stage="thread_create"):
+                thread = await call_openai(PRIORITY_NORMAL, client_openai.beta.threads.create)
+            thread_id = thread.id
+            thread_store.set(channel_id, thread_id)
+            log.info(f"[Channel {channel_id}] Created thread ID: {thread_id}")
+        except GovernorQueueFull:
+            log.warning(f"[Channel {channel_id}] Too many OpenAI calls waiting, not creating a thread.")
+            await outbound.post(message.channel, RATE_LIMIT_REPLY)
+            return
+        except Exception as e:
+            log.error(f"Error creating thread: {e}")
+            await outbound.post(message.channel, "Sorry, I couldn't start a new conversation thread.")
+            return
+    else:
+        log.info(f"[Channel {channel_id}] Using existing thread ID: {thread_id}")
+
+    # --- Compact Long Threads ---
+    compaction = plan_compaction(channel_id)
+    if compaction == "rolled_over":
+        new_thread_id = await roll_over_thread(channel_id, thread_id)
+        if new_thread_id is None:
+            compaction = "truncated"
+        else:
+            thread_id = new_thread_id
+    run_options = {}
+    if compaction == "truncated":
+        keep = compaction_settings(channel_id)['keep_messages']
+        run_options['truncation_strategy'] = {"type": "last_messages", "last_messages": keep}
+        metrics.inc("keith_thread_compactions_total", kind="truncated")
+        log.info(f"[Channel {channel_id}] Thread {thread_id} is long, runs will only read its last {keep} messages.")
+
+    tracker = RunTracker(message, thread_id)
+    active = active_replies.get(message.id)
+    if active is not None:
+        active.tracker = tracker
+    try:
+        log.info(f"[Channel {channel_id}] Adding message to thread {thread_id}...")
+        with metrics.timed("keith_stage_seconds", stage="message_create"):
+            thread_message = await call_openai(
+                PRIORITY_NORMAL, client_openai.beta.threads.messages.create,
                 thread_id=thread_id,
                 role="user",
                 content=user_prompt,
             )
-        except Exception as e:
-            if "No thread found" in str(e) or ("not_found" in str(e).lower() and "thread" in str(e).lower()):
-                 print(f"[Channel {channel_id}] Thread {thread_id} seems to be deleted. Removing from cache and asking user to retry.")
-                 if channel_id in channel_threads:
-                     del channel_threads[channel_id]
-                 await message.channel.send("It seems our previous conversation history was lost. Please try sending your message again to start a new one.")
-            else: # Original error handling for other add message errors
-                print(f"Error adding message to thread: {e}")
-                await message.channel.send("Sorry, I couldn't process your message.")
-            return # Return on any add message error
-        try:
-            print(f"[Channel {channel_id}] Creating run for thread {thread_id} with assistant {ASSISTANT_ID}...")
-            async with message.channel.typing(): # Show "typing..." in Discord
-                run = client_openai.beta.threads.runs.create(
-                    thread_id=thread_id,
-                    assistant_id=ASSISTANT_ID,
-                    # Instructions/model are defined in the portal assistant, no need to override here
-                    # unless you specifically want to for a single run.
-                )
-                print(f"[Channel {channel_id}] Created run ID: {run.id}")
-
-                max_poll_time = 300 # Maximum seconds to wait
-                start_time = time.time()
-                # --- Modified polling loop to use asyncio.sleep ---
-                # Original used time.sleep(1) which blocks the event loop
-                while run.status in ['queued', 'in_progress']:
-                    if time.time() - start_time > max_poll_time:
-                         print(f"[Channel {channel_id}] Run timed out.")
-                         try:
-                             print(f"[Channel {channel_id}] Attempting to cancel timed out run {run.id}...")
-                             client_openai.beta.threads.runs.cancel(thread_id=thread_id, run_id=run.id)
-                             print(f"[Channel {channel_id}] Cancel request sent for run {run.id}.")
-                         except Exception as cancel_err:
-                             print(f"[Channel {channel_id}] Error attempting to cancel run {run.id}: {cancel_err}")
-                         await message.channel.send("Sorry, the request took too long to process.")
-                         return
-
-                    await asyncio.sleep(1.5) 
-                    try: 
-                        run = client_openai.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
-                        print(f"[Channel {channel_id}] Run status: {run.status}")
-                    except openai.NotFoundError:
-                        print(f"[Channel {channel_id}] Error polling run {run.id}: Run or Thread not found.")
-                        await message.channel.send("There was an issue tracking the AI's progress (run/thread not found).")
-                        if channel_id in channel_threads: del channel_threads[channel_id]
+    except GovernorQueueFull:
+        log.warning(f"[Channel {channel_id}] Too many OpenAI calls waiting, dropping prompt.")
+        await outbound.post(message.channel, RATE_LIMIT_REPLY)
+        return
+    except Exception as e:
+        if "No thread found" in str(e) or ("not_found" in str(e).lower() and "thread" in str(e).lower()):
+             log.warning(f"[Channel {channel_id}] Thread {thread_id} seems to be deleted. Removing from cache and asking user to retry.")
+             thread_store.invalidate(channel_id)
+             await outbound.post(message.channel, "It seems our previous conversation history was lost. Please try sending your message again to start a new one.")
+        else: # Original error handling for other add message errors
+            log.error(f"Error adding message to thread: {e}")
+            await outbound.post(message.channel, "Sorry, I couldn't process your message.")
+        return # Return on any add message error
+    tracker.prompt_message_id = thread_message.id
+    run_tokens = estimate_tokens(user_prompt) + RUN_TOKEN_ESTIMATE
+    run = None
+    cancelled = False
+    metrics.add("keith_runs_in_flight", 1, channel=channel_id)
+    try:
+        tracker.run_requested = True
+        if STREAM_RESPONSES:
+            run = await stream_run(message, thread_id, received_at, run_tokens, tracker, compaction, run_options)
+            return
+
+        log.info(f"[Channel {channel_id}] Creating run for thread {thread_id} with assistant {ASSISTANT_ID}...")
+        async with message.channel.typing(): # Show "typing..." in Discord
+            run = await call_openai(
+                PRIORITY_NEW_RUN, client_openai.beta.threads.runs.create,
+                tokens=run_tokens,
+                thread_id=thread_id,
+                assistant_id=ASSISTANT_ID,
+                # Instructions/model are defined in the portal assistant, no need to override here
+                # unless you specifically want to for a single run.
+                **run_options,
+            )
+            log.info(f"[Channel {channel_id}] Created run ID: {run.id}")
+            await tracker.started(run)
+
+            try:
+                run = await run_poller.wait(thread_id, run, channel_id, compaction)
+            except RunTimeoutError:
+                await outbound.post(message.channel, "Sorry, the request took too long to process.")
+                return
+            except openai.NotFoundError:
+                await outbound.post(message.channel, "There was an issue tracking the AI's progress (run/thread not found).")
+                thread_store.invalidate(channel_id)
+                return
+
+            if run.status == 'completed':
+                log.info(f"[Channel {channel_id}] Run completed. Retrieving messages...")
+                response_text = await fetch_run_reply(thread_id, run.id)
+                if response_text is not None:
+                    log.info(f"[Channel {channel_id}] Assistant response: '{response_text}'")
+                    if not await tracker.claim():
+                        log.warning(f"[Channel {channel_id}] Reply for run {run.id} was already delivered elsewhere.")
                         return
-                    except Exception as poll_err:
-                        print(f"[Channel {channel_id}] Error polling run {run.id}: {poll_err}")
-                        await asyncio.sleep(3)
-
-
-                if run.status == 'completed':
-                    print(f"[Channel {channel_id}] Run completed. Retrieving messages...")
-                    messages = client_openai.beta.threads.messages.list(
-                        thread_id=thread_id,
-                        order='desc' # Latest messages first
-                    )
-                    # Find the latest message from the assistant for this run
-                    assistant_message = None
-                    for msg in messages.data:
-                        if msg.run_id == run.id and msg.role == 'assistant':
-                            assistant_message = msg
-                            break # Found the newest relevant message
-
-                    if assistant_message and assistant_message.content:
-                        response_text = ""
-                        for content_block in assistant_message.content:
-                            if content_block.type == 'text':
-                                response_text += content_block.text.value
-                                # If you expect multiple text blocks, remove the break
-
-                        print(f"[Channel {channel_id}] Assistant response: '{response_text}'")
-
-                        # Send response (handle Discord length limit)
-                        if len(response_text) > 2000:
-                            print(f"[Channel {channel_id}] Response is long ({len(response_text)} chars), splitting.")
-                            parts = []
-                            current_part = ""
-                            for paragraph in response_text.split('\n'):
-                                if len(current_part) + len(paragraph) + 1 <= 2000:
-                                    current_part += paragraph + "\n"
-                                else:
-                                    if current_part: parts.append(current_part.strip())
-                                    if len(paragraph) > 2000:
-                                         for i in range(0, len(paragraph), 1990): parts.append(paragraph[i:i+1990])
-                                         current_part = ""
-                                    else: current_part = paragraph + "\n"
-                            if current_part: parts.append(current_part.strip())
-                            for part in parts:
-                                if part: await message.channel.send(part)
-                        elif len(response_text) > 0:
-                            await message.channel.send(response_text)
+
+                    # Send response (handle Discord length limit)
+                    with metrics.timed("keith_stage_seconds", stage="discord_send"):
+                        if len(response_text) > DISCORD_MESSAGE_LIMIT:
+                            log.info(f"[Channel {channel_id}] Response is long ({len(response_text)} chars), splitting.")
+                        if len(response_text) > 0:
+                            await outbound.send(message.channel, response_text)
                         else:
-                             await message.channel.send("I received an empty response.") 
-                    else:
-                        print(f"[Channel {channel_id}] No assistant message found for run {run.id}") 
-                        await message.channel.send("Sorry, I couldn't retrieve a response for this interaction.") 
-
-                elif run.status in ['failed', 'cancelled', 'expired', 'requires_action']:
-                    # requires_action is for function calling, which we aren't using here yet
-                    print(f"[Channel {channel_id}] Run ended with status: {run.status}") 
-                    error_message = f"Sorry, the process ended with status: {run.status}." 
-                    if run.last_error:
-                        error_message += f" Error Code: {run.last_error.code}. Message: {run.last_error.message}"
-                    # You might want specific handling for 'requires_action' if you add tools/functions later
-                    await message.channel.send(error_message[:1950]) # Limit length, original just sent potentially long message
+                             await outbound.post(message.channel, "I received an empty response.") 
                 else:
-                     print(f"[Channel {channel_id}] Run ended with unexpected status: {run.status}") 
-                     await message.channel.send(f"Sorry, something went wrong ({run.status}).") 
+                    log.info(f"[Channel {channel_id}] No assistant message found for run {run.id}")
+                    await outbound.post(message.channel, "Sorry, I couldn't retrieve a response for this interaction.") 
+
+            elif run.status in ['failed', 'cancelled', 'expired', 'requires_action']:
+                # requires_action is for function calling, which we aren't using here yet
+                log.info(f"[Channel {channel_id}] Run ended with status: {run.status}")
+                # You might want specific handling for 'requires_action' if you add tools/functions later
+                await outbound.post(message.channel, run_error_message(run))
+            else:
+                 log.info(f"[Channel {channel_id}] Run ended with unexpected status: {run.status}")
+                 await outbound.post(message.channel, f"Sorry, something went wrong ({run.status}).") 
+
+    except (openai.RateLimitError, GovernorQueueFull):
+         log.error("OpenAI Rate Limit Exceeded.")
+         await outbound.post(message.channel, RATE_LIMIT_REPLY)
+    except openai.AuthenticationError:
+         log.error("OpenAI Authentication Failed. Check your API Key.")
+         await outbound.post(message.channel, AUTH_ERROR_REPLY)
+    except openai.NotFoundError as e:
+         log.error(f"[Channel {channel_id}] OpenAI resource not found during run/retrieval: {e}")
+         await outbound.post(message.channel, "Sorry, it seems the conversation context was lost or expired before the AI could finish. Please try again.")
+         thread_store.invalidate(channel_id)
+    except Exception as e:
+        log.error(f"An unexpected error occurred during run/retrieval: {e}")
+        # Optional: Log full traceback
+        # import traceback; traceback.print_exc()
+        await outbound.post(message.channel, UNEXPECTED_ERROR_REPLY)
+    except asyncio.CancelledError:
+        # Shutting down (the journal entry lets the next start finish the run), or
+        # superseded (cancel_active_reply cleans up)
+        cancelled = True
+        raise
+    finally:
+        record_thread_growth(channel_id, user_prompt, run, compaction)
+        metrics.add("keith_runs_in_flight", -1, channel=channel_id)
+        metrics.observe("keith_reply_seconds", time.monotonic() - received_at)
+        if not cancelled:
+            await tracker.done()
+
+
+# --- Resuming Runs After a Restart ---
+def owns_guild(guild_id):
+    """Whether this process gets the events for a guild (DMs arrive on shard 0)."""
+    if worker_index is None:
+        return True
+    shard_id = 0 if guild_id is None else (guild_id >> 22) % client_discord.shard_count
+    return shard_id in client_discord.shard_ids
+
+
+async def resume_journaled_runs():
+    """Finishes the runs a previous process left in the journal. Started once from on_ready."""
+    try:
+        entries = await run_journal.orphans()
+    except Exception as e:
+        log.error(f"Couldn't read the run journal: {e}")
+        return
+    entries = [entry for entry in entries if owns_guild(entry.guild_id)]
+    if entries:
+        log.info(f"Found {len(entries)} unfinished run(s) from before the restart.")
+    tasks = []
+    for entry in entries:
+        if entry.channel_id in channel_workers:
+            continue # A new prompt got there first; the old run's reply would interleave with it
+        if not await run_journal.adopt(entry):
+            continue
+        # Hold the channel like a worker would, so new prompts queue up behind the resumed run
+        task = asyncio.create_task(resume_run(entry))
+        channel_workers[entry.channel_id] = task
+        tasks.append(task)
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def resume_run(entry):
+    """Waits for a journaled run (or cancels it if it is too old) and replies to the original message."""
+    channel_id = entry.channel_id
+    age = time.time() - entry.started_at
+    outcome = "failed"
+    shutting_down = False
+    try:
+        if age > RUN_TIMEOUT:
+            log.info(f"[Channel {channel_id}] Run {entry.run_id} from before the restart is {age:.0f}s old, cancelling it.")
+            await run_poller.cancel_run(entry.thread_id, entry.run_id, channel_id, "stale_after_restart")
+            outcome = "cancelled"
+            return
+        log.info(f"[Channel {channel_id}] Resuming run {entry.run_id} from before the restart ({age:.0f}s old)...")
+        run = await call_openai(
+            PRIORITY_CONTROL, client_openai.beta.threads.runs.retrieve,
+            thread_id=entry.thread_id, run_id=entry.run_id,
+        )
+        try:
+            run = await run_poller.wait(entry.thread_id, run, channel_id, timeout=RUN_TIMEOUT - age)
+        except RunTimeoutError:
+            outcome = "timeout"
+            return
+        if run.status == 'completed':
+            response_text = await fetch_run_reply(entry.thread_id, run.id)
+            if response_text is None:
+                response_text = "Sorry, I couldn't retrieve a response for this interaction."
+        else:
+            response_text = run_error_message(run)
+        if not await run_journal.claim(entry.run_id):
+            log.warning(f"[Channel {channel_id}] Reply for run {entry.run_id} was already delivered elsewhere.")
+            outcome = "duplicate"
+            return
+        await deliver_resumed_reply(entry, response_text or "I received an empty response.")
+        outcome = "delivered"
+        log.info(f"[Channel {channel_id}] Delivered the reply for resumed run {entry.run_id}.")
+    except asyncio.CancelledError:
+        shutting_down = True # Still unfinished; the next start tries again
+        raise
+    except Exception as e:
+        log.error(f"[Channel {channel_id}] Couldn't resume run {entry.run_id}: {e}")
+    finally:
+        if not shutting_down:
+            metrics.inc("keith_resumed_runs_total", outcome=outcome)
+            try:
+                await run_journal.remove(entry.run_id)
+            except Exception as e:
+                log.error(f"[Channel {channel_id}] Couldn't remove run {entry.run_id} from the journal: {e}")
+        # Hand the channel to a regular worker if prompts came in meanwhile
+        if channel_workers.get(channel_id) is asyncio.current_task():
+            del channel_workers[channel_id]
+            if channel_queues.get(channel_id) and not shutting_down:
+                channel_workers[channel_id] = asyncio.create_task(channel_worker(channel_id))
+
+
+async def deliver_resumed_reply(entry, response_text):
+    """Replies to the journaled message, replacing the half-typed streaming reply if there was one."""
+    channel = client_discord.get_channel(entry.channel_id) or await client_discord.fetch_channel(entry.channel_id)
+    if entry.placeholder_id:
+        try:
+            await channel.get_partial_message(entry.placeholder_id).delete()
+        except discord.HTTPException:
+            pass # Already gone
+    # Replies to the original message, or just posts if it was deleted meanwhile
+    reference = discord.MessageReference(message_id=entry.message_id, channel_id=entry.channel_id,
+                                         fail_if_not_exists=False)
+    with metrics.timed("keith_stage_seconds", stage="discord_send"):
+        await outbound.send(channel, response_text, reference=reference, mention_author=False)
+
+
+
+
+# --- Conversation Backends ---
+class ConversationBackend(abc.ABC):
+    """Answers a (possibly coalesced) Keith prompt in the message's channel."""
+
+    name = None
+
+    @abc.abstractmethod
+    async def respond(self, message, user_prompt, received_at):
+        ...
+
+
+class AssistantsBackend(ConversationBackend):
+    """OpenAI Assistants API: a thread per channel and a run per reply."""
+
+    name = "assistants"
+
+    async def respond(self, message, user_prompt, received_at):
+        await answer_prompt(message, user_prompt, received_at)
+
+
+class ChatCompletionsBackend(ConversationBackend):
+    """
+    One streaming Chat Completions request per reply. The last CHAT_HISTORY_MESSAGES
+    messages of each channel are kept in a local ring buffer and sent along as context.
+    """
+
+    name = "chat"
+
+    def __init__(self):
+        self.histories = OrderedDict() # channel_id -> deque of {"role", "content"}, LRU order
+
+    def history(self, channel_id):
+        history = self.histories.get(channel_id)
+        if history is None:
+            history = self.histories[channel_id] = deque(maxlen=CHAT_HISTORY_MESSAGES)
+            while len(self.histories) > CHAT_HISTORY_CHANNELS:
+                self.histories.popitem(last=False)
+        self.histories.move_to_end(channel_id)
+        return history
+
+    def model(self):
+        return CHAT_MODEL or getattr(assistant_profile, "model", None) or CHAT_DEFAULT_MODEL
 
-        except openai.RateLimitError:
-             print("ERROR: OpenAI Rate Limit Exceeded.")
-             await message.channel.send("Sorry, I'm getting too many requests right now (Rate Limit). Please try again in a moment.") 
+    def system_prompt(self):
+        return CHAT_SYSTEM_PROMPT or getattr(assistant_profile, "instructions", None) or "You are Keith, a helpful Discord bot."
+
+    async def respond(self, message, user_prompt, received_at):
+        channel_id = message.channel.id
+        log.info(f"[Channel {channel_id}] Received prompt from {message.author} (chat backend): '{user_prompt}'")
+        history = self.history(channel_id)
+        await assistant_ready() # Default model and instructions come from the Assistant
+        request_messages = [{"role": "system", "content": self.system_prompt()}, *history,
+                            {"role": "user", "content": user_prompt}]
+        tokens = sum(estimate_tokens(m["content"]) for m in request_messages) + RUN_TOKEN_ESTIMATE
+        reply = StreamingReply(message.channel, received_at)
+        active = active_replies.get(message.id)
+        if active is not None:
+            active.reply = reply
+        metrics.add("keith_runs_in_flight", 1, channel=channel_id)
+        try:
+            await reply.start()
+            with metrics.timed("keith_stage_seconds", stage="chat_completion"):
+                stream = await call_openai(
+                    PRIORITY_NEW_RUN, client_openai.chat.completions.create,
+                    model=self.model(), messages=request_messages, stream=True, tokens=tokens,
+                )
+                try:
+                    await asyncio.wait_for(self._consume(stream, reply), timeout=RUN_TIMEOUT)
+                except asyncio.TimeoutError:
+                    log.warning(f"[Channel {channel_id}] Chat completion timed out.")
+                    metrics.inc("keith_run_status_total", status="timeout")
+                    await stream.close()
+                    await reply.finish("Sorry, the request took too long to process.")
+                    return
+                except asyncio.CancelledError:
+                    await stream.close() # Stop the generation we no longer want
+                    raise
+            await reply.finish("I received an empty response.")
+            if reply.text.strip():
+                history.append({"role": "user", "content": user_prompt})
+                history.append({"role": "assistant", "content": reply.text})
+            log.info(f"[Channel {channel_id}] Chat response finished ({len(reply.text)} chars).")
+        except (openai.RateLimitError, GovernorQueueFull):
+            log.error("OpenAI Rate Limit Exceeded.")
+            await reply.discard()
+            await outbound.post(message.channel, RATE_LIMIT_REPLY)
         except openai.AuthenticationError:
-             print("ERROR: OpenAI Authentication Failed. Check your API Key.")
-             await message.channel.send("Sorry, there's an issue with my connection to the AI (Authentication Error). Please tell the bot owner.") 
-        except openai.NotFoundError as e:
-             print(f"[Channel {channel_id}] ERROR: OpenAI resource not found during run/retrieval: {e}")
-             await message.channel.send("Sorry, it seems the conversation context was lost or expired before the AI could finish. Please try again.")
-             if channel_id in channel_threads: del channel_threads[channel_id]
+            log.error("OpenAI Authentication Failed. Check your API Key.")
+            await reply.discard()
+            await outbound.post(message.channel, AUTH_ERROR_REPLY)
         except Exception as e:
-            print(f"An unexpected error occurred during run/retrieval: {e}") 
-            # Optional: Log full traceback
-            # import traceback; traceback.print_exc()
-            await message.channel.send("Sorry, an unexpected error occurred while getting the response.") 
-
-
-try:
-    client_discord.run(BOT_TOKEN)
-except discord.errors.LoginFailure:
-    print("\nERROR: Improper Discord token passed. Make sure the DISCORD_BOT_TOKEN is correct.")
-except discord.errors.PrivilegedIntentsRequired:
-    print("\nERROR: Privileged Intents (like Message Content) are required but not enabled.")
-    print("Go to your bot's settings in the Discord Developer Portal and enable 'MESSAGE CONTENT INTENT'.")
-except Exception as e:
-    print(f"Error running Discord client: {e}")
-finally:
-    print("Discord client stopped.")
-    with manual_mode_lock:
-        if manual_mode_active:
-             print("Signalling active manual mode thread to stop due to bot shutdown...")
-             manual_mode_active = False
+            log.error(f"[Channel {channel_id}] An unexpected error occurred during chat completion: {e}")
+            await reply.discard()
+            await outbound.post(message.channel, UNEXPECTED_ERROR_REPLY)
+        finally:
+            metrics.add("keith_runs_in_flight", -1, channel=channel_id)
+            metrics.observe("keith_reply_seconds", time.monotonic() - received_at)
+
+    @staticmethod
+    async def _consume(stream, reply):
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                await reply.add(chunk.choices[0].delta.content)
+
+
+BACKENDS = {backend.name: backend for backend in (AssistantsBackend(), ChatCompletionsBackend())}
+
+
+def backend_for(channel_id):
+    """The backend answering a channel: its CHANNEL_BACKENDS override, or BACKEND."""
+    return BACKENDS[CHANNEL_BACKENDS.get(channel_id, BACKEND)]
+
+
+# --- Sharded Mode ---
+EXIT_FATAL = 2 # Worker exit code for errors a restart won't fix (bad token, missing intents)
+WORKER_RESTART_MAX_DELAY = 60
+
+
+def shard_groups(shard_count, processes):
+    """Splits shard IDs 0..shard_count-1 into up to `processes` contiguous, evenly sized groups."""
+    processes = max(1, min(processes, shard_count))
+    size, extra = divmod(shard_count, processes)
+    groups, start = [], 0
+    for i in range(processes):
+        end = start + size + (1 if i < extra else 0)
+        groups.append(list(range(start, end)))
+        start = end
+    return groups
+
+
+async def fetch_recommended_shards(token):
+    """Asks Discord how many shards the bot should use."""
+    import aiohttp # Installed with discord.py
+    async with aiohttp.ClientSession() as session:
+        async with session.get("https://discord.com/api/v10/gateway/bot",
+                               headers={"Authorization": f"Bot {token}"}) as response:
+            response.raise_for_status()
+            return (await response.json())["shards"]
+
+
+def _raise_keyboard_interrupt(signum, frame):
+    raise KeyboardInterrupt # Lets SIGTERM shut down as cleanly as Ctrl+C
+
+
+class Supervisor:
+    """
+    Runs one worker process per shard group and restarts workers that die, backing off if
+    they keep dying. Worker start-ups are staggered so their shards don't log in at once.
+    """
+
+    def __init__(self, shard_count, groups):
+        self.shard_count = shard_count
+        self.groups = groups
+        self.processes = {} # worker index -> Popen
+        self.start_at = {} # worker index -> monotonic time to (re)start it
+        self.started_at = {}
+        self.restart_delay = {}
+
+    def command(self, index):
+        return [
+            sys.executable, os.path.abspath(__file__),
+            "--shard-worker", str(index),
+            "--shards", ",".join(map(str, self.groups[index])),
+            "--shard-count", str(self.shard_count),
+        ]
+
+    def run(self):
+        """Supervises until interrupted or a worker hits a fatal error. Returns the exit code."""
+        signal.signal(signal.SIGTERM, _raise_keyboard_interrupt)
+        now = time.monotonic()
+        shards_before = 0
+        for index, group in enumerate(self.groups):
+            self.start_at[index] = now + shards_before * SHARD_IDENTIFY_INTERVAL
+            shards_before += len(group)
+        try:
+            while True:
+                now = time.monotonic()
+                for index in list(self.start_at):
+                    if now >= self.start_at[index]:
+                        del self.start_at[index]
+                        self._start(index, now)
+                for index, process in list(self.processes.items()):
+                    code = process.poll()
+                    if code is None:
+                        continue
+                    del self.processes[index]
+                    if code == EXIT_FATAL:
+                        log.error(f"[Supervisor] Worker {index} hit a fatal error, shutting down.")
+                        return 1
+                    self._schedule_restart(index, code, now)
+                time.sleep(0.5)
+        except KeyboardInterrupt:
+            log.info("[Supervisor] Shutting down workers...")
+            return 0
+        finally:
+            self.stop()
+
+    def stop(self, timeout=15):
+        for process in self.processes.values():
+            if process.poll() is None:
+                if os.name == "posix":
+                    process.send_signal(signal.SIGINT) # Lets the worker flush its thread store
+                else:
+                    process.terminate()
+        deadline = time.monotonic() + timeout
+        for index, process in self.processes.items():
+            try:
+                process.wait(timeout=max(0.1, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                log.warning(f"[Supervisor] Worker {index} didn't stop in time, killing it.")
+                process.kill()
+        self.processes.clear()
+
+    def _start(self, index, now):
+        log.info(f"[Supervisor] Starting worker {index} for shards {self.groups[index]} of {self.shard_count}.")
+        self.processes[index] = subprocess.Popen(self.command(index), stdin=subprocess.DEVNULL)
+        self.started_at[index] = now
+
+    def _schedule_restart(self, index, code, now):
+        # Reset the back-off once a worker has stayed up for a while
+        if now - self.started_at[index] > WORKER_RESTART_MAX_DELAY:
+            self.restart_delay[index] = 0
+        delay = min(WORKER_RESTART_MAX_DELAY, max(SHARD_IDENTIFY_INTERVAL, 2 * self.restart_delay.get(index, 0)))
+        self.restart_delay[index] = delay
+        log.warning(f"[Supervisor] Worker {index} exited with code {code}, restarting in {delay:.0f}s.")
+        self.start_at[index] = now + delay
+
+
+def run_supervisor():
+    shard_count = SHARD_COUNT
+    if shard_count == "auto":
+        try:
+            shard_count = asyncio.run(fetch_recommended_shards(BOT_TOKEN))
+        except Exception as e:
+            log.error(f"Could not get the recommended shard count from Discord: {e}")
+            return 1
+    groups = shard_groups(shard_count, SHARD_PROCESSES)
+    log.info(f"Running {shard_count} shards in {len(groups)} worker processes.")
+    return Supervisor(shard_count, groups).run()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Keith, a Discord bot backed by an OpenAI Assistant.")
+    parser.add_argument("--check", action="store_true",
+                        help="Check the configuration, log in, report the cold-start time to gateway ready, and exit. "
+                             "Doesn't answer messages or resume runs. With SHARD_COUNT set, all shards run in this process.")
+    # Used by the supervisor to start sharded workers
+    parser.add_argument("--shard-worker", type=int, metavar="INDEX", help=argparse.SUPPRESS)
+    parser.add_argument("--shards", help=argparse.SUPPRESS)
+    parser.add_argument("--shard-count", type=int, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def sharded_client(**kwargs):
+    """An AutoShardedClient with Keith's event handlers, replacing the default client."""
+    client = discord.AutoShardedClient(intents=intents, **kwargs)
+    for handler in (on_ready, on_message, on_raw_message_delete, on_raw_message_edit):
+        client.event(handler)
+    return client
+
+
+def main():
+    global client_openai, client_discord, manual_mode_active, worker_index, shared_limits, check_mode
+    startup_times["main"] = time.perf_counter()
+    args = parse_args()
+    worker_index = args.shard_worker
+    check_mode = args.check
+    if worker_index is not None:
+        setup_logging(f"worker {worker_index}")
+    else:
+        setup_logging("supervisor" if SHARD_COUNT is not None and not check_mode else None)
+    if not check_config():
+        sys.exit(1)
+    if worker_index is None and SHARD_COUNT is not None and not check_mode:
+        sys.exit(run_supervisor())
+    client_openai = make_openai_client(OPENAI_API_KEY)
+    if worker_index is not None:
+        signal.signal(signal.SIGTERM, _raise_keyboard_interrupt)
+        client_discord = sharded_client(
+            shard_ids=[int(shard_id) for shard_id in args.shards.split(",")],
+            shard_count=args.shard_count,
+        )
+        shared_limits = SharedRateLimits(THREAD_DB_PATH, worker_index, interval=GOVERNOR_SYNC_INTERVAL)
+    elif check_mode and SHARD_COUNT is not None:
+        client_discord = sharded_client(shard_count=None if SHARD_COUNT == "auto" else SHARD_COUNT)
+
+    exit_code = 0
+    startup_times["connect"] = time.perf_counter()
+    try:
+        client_discord.run(BOT_TOKEN, log_handler=None) # Our queue-based logging is already set up
+    except discord.errors.LoginFailure:
+        log.error("Improper Discord token passed. Make sure the DISCORD_BOT_TOKEN is correct.")
+        exit_code = EXIT_FATAL
+    except discord.errors.PrivilegedIntentsRequired:
+        log.error("Privileged Intents (like Message Content) are required but not enabled.")
+        log.error("Go to your bot's settings in the Discord Developer Portal and enable 'MESSAGE CONTENT INTENT'.")
+        exit_code = EXIT_FATAL
+    except Exception as e:
+        log.error(f"Error running Discord client: {e}")
+        exit_code = 1
+    finally:
+        log.info("Discord client stopped.")
+        try:
+            thread_store.close()
+        except Exception as e:
+            log.error(f"Error saving channel threads: {e}")
+        run_journal.close()
+        if shared_limits is not None:
+            try:
+                shared_limits.close()
+            except Exception as e:
+                log.error(f"Error closing shared rate-limit state: {e}")
+        with manual_mode_lock:
+            if manual_mode_active:
+                 log.warning("Signalling active manual mode thread to stop due to bot shutdown...")
+                 manual_mode_active = False
+    if check_mode and not exit_code:
+        exit_code = 0 if check_passed else 1
+    if exit_code:
+        sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+"""
+Tiny in-process metrics registry for Keith.
+
+Keeps histograms, counters and gauges in memory, renders them in the Prometheus
+text exposition format and can serve them from a minimal local HTTP endpoint.
+"""
+import asyncio
+import bisect
+import logging
+import time
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (v.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metrics:
+    """
+    Registry of named metrics. Register a metric once with counter()/gauge()/histogram(),
+    then record with inc()/set()/add()/observe() and any labels you like.
+    Collectors registered with add_collector() run right before each render, for values
+    that are cheaper to read on demand than to keep updated.
+    """
+
+    def __init__(self):
+        self._meta = {} # name -> (type, help)
+        self._buckets = {} # histogram name -> bucket bounds
+        self._values = {} # name -> {label key -> value}
+        self._histograms = {} # name -> {label key -> [bucket counts, sum, count]}
+        self._collectors = []
+
+    # --- Registration ---
+    def counter(self, name, help_text):
+        self._register(name, "counter", help_text)
+
+    def gauge(self, name, help_text):
+        self._register(name, "gauge", help_text)
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self._register(name, "histogram", help_text)
+        self._buckets[name] = tuple(sorted(buckets))
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def _register(self, name, kind, help_text):
+        self._meta[name] = (kind, help_text)
+        if kind == "histogram":
+            self._histograms.setdefault(name, {})
+        else:
+            self._values.setdefault(name, {})
+
+    # --- Recording ---
+    def inc(self, name, amount=1, **labels):
+        values = self._values[name]
+        key = _label_key(labels)
+        values[key] = values.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        self._values[name][_label_key(labels)] = value
+
+    def add(self, name, delta, **labels):
+        """Adjusts a gauge. Series that drop back to zero are removed so per-channel labels stay bounded."""
+        values = self._values[name]
+        key = _label_key(labels)
+        value = values.get(key, 0) + delta
+        if value:
+            values[key] = value
+        else:
+            values.pop(key, None)
+
+    def observe(self, name, value, **labels):
+        buckets = self._buckets[name]
+        series = self._histograms[name].setdefault(_label_key(labels), [[0] * len(buckets), 0.0, 0])
+        index = bisect.bisect_left(buckets, value)
+        if index < len(buckets):
+            series[0][index] += 1
+        series[1] += value
+        series[2] += 1
+
+    @contextmanager
+    def timed(self, name, **labels):
+        """Observes how long the with-block took, in seconds (also when it raises)."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    def totals(self, name):
+        """Returns {labels: (count, sum)} for a histogram, labels as a sorted tuple of pairs."""
+        return {key: (count, total) for key, (_, total, count) in self._histograms[name].items()}
+
+    # --- Export ---
+    def render(self):
+        """Returns every metric in the Prometheus text format."""
+        for collector in self._collectors:
+            try:
+                collector()
+            except Exception as e:
+                log.error(f"Metrics collector {collector!r} failed: {e}")
+        lines = []
+        for name, (kind, help_text) in self._meta.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind != "histogram":
+                for key, value in list(self._values[name].items()):
+                    lines.append(f"{name}{_format_labels(key)} {_format_value(value)}")
+                continue
+            bounds = self._buckets[name]
+            for key, (counts, total, count) in list(self._histograms[name].items()):
+                cumulative = 0
+                for bound, bucket_count in zip(bounds, counts):
+                    cumulative += bucket_count
+                    lines.append(f"{name}_bucket{_format_labels(key, [('le', _format_value(bound))])} {cumulative}")
+                lines.append(f"{name}_bucket{_format_labels(key, [('le', '+Inf')])} {count}")
+                lines.append(f"{name}_sum{_format_labels(key)} {_format_value(total)}")
+                lines.append(f"{name}_count{_format_labels(key)} {count}")
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, host, port):
+        """Serves render() at http://host:port/metrics. Returns the asyncio server."""
+        server = await asyncio.start_server(self._handle_http, host, port)
+        log.info(f"Serving metrics on http://{host}:{port}/metrics")
+        return server
+
+    async def _handle_http(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+                pass # Headers are not needed
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", self.render().encode("utf-8")
+            else:
+                status, body = "404 Not Found", b"Not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n".encode("latin-1") + body
+            )
+            await writer.drain()
+        except Exception as e:
+            log.debug(f"Metrics request failed: {e}")
+        finally:
+            writer.close()
@@ -0,0 +1,260 @@
+"""
+Outbound Discord messages for Keith.
+
+chunk_message() splits long text into Discord-sized messages in a single pass, without
+breaking code blocks. OutboundSender sends every message through a per-channel queue that
+is paced to stay inside Discord's rate limits, so sends wait their turn instead of running
+into 429s, and very long answers are uploaded as a text file instead of a wall of messages.
+"""
+import asyncio
+import io
+import logging
+import time
+
+import discord
+
+log = logging.getLogger(__name__)
+
+DISCORD_MESSAGE_LIMIT = 2000
+FENCE_MARKERS = ("```", "~~~")
+ATTACHMENT_NOTE = "*(This answer is long, so the full text is attached.)*"
+MAX_IDLE_CHANNELS = 1024 # Idle channel queues kept around before they are swept
+
+
+def _fence_after(line, fence):
+    """The code fence open after `line`, given the one open before it (None outside code blocks)."""
+    stripped = line.strip()
+    marker = stripped[:3]
+    if marker not in FENCE_MARKERS:
+        return fence
+    if fence is None:
+        return None if marker in stripped[3:] else stripped # "```x```" opens and closes on one line
+    if fence.startswith(marker) and not stripped.strip(marker[0]):
+        return None
+    return fence
+
+
+def _fence_closer(fence):
+    return fence[:len(fence) - len(fence.lstrip(fence[0]))]
+
+
+def chunk_message(text, limit=DISCORD_MESSAGE_LIMIT):
+    """
+    Splits text into chunks of at most `limit` characters, in time linear in len(text).
+    Prefers line breaks, then spaces. A code block that has to be split is closed at the
+    end of one chunk and reopened (with its language) at the start of the next.
+    """
+    chunks = []
+    pieces = []
+    size = 0
+    base = 0 # Size of the reopened fence a chunk starts with
+    fence = None # Opening line of the code block we are in, e.g. "```python"
+    opener = None # (index in pieces, size after it) of a code block opened in the current chunk
+
+    def flush():
+        nonlocal pieces, size, base, opener
+        close = fence is not None
+        if opener is not None and opener[1] == size:
+            # Nothing followed the opening fence yet: leave the whole block to the next chunk
+            del pieces[opener[0]:]
+            close = False
+        if size > base:
+            body = "".join(pieces).strip("\n")
+            if close:
+                body += "\n" + _fence_closer(fence)
+            if body.strip():
+                chunks.append(body)
+        pieces = [fence + "\n"] if fence is not None else []
+        size = base = len(pieces[0]) if pieces else 0
+        opener = None
+
+    for line in text.splitlines(keepends=True):
+        next_fence = _fence_after(line, fence)
+        reserve = len(_fence_closer(next_fence)) + 1 if next_fence is not None else 0
+        start, end = 0, len(line)
+        while start < end:
+            room = limit - size - reserve
+            if end - start <= room:
+                pieces.append(line[start:] if start else line)
+                size += end - start
+                if fence is None and next_fence is not None:
+                    opener = (len(pieces) - 1, size)
+                break
+            if size > base:
+                flush() # Start the line in a fresh chunk
+                continue
+            # The line doesn't even fit in an empty chunk: cut it, at a space if there's one nearby
+            cut = line.rfind(" ", start + room // 2, start + room) + 1 or start + room
+            pieces.append(line[start:cut])
+            size += cut - start
+            start = cut
+            flush()
+        fence = next_fence
+    flush() # Also closes a code block the text left open
+    return chunks
+
+
+class _Pacer:
+    """Token bucket: up to `burst` sends at once, refilling at `rate` per second."""
+
+    def __init__(self, burst, rate):
+        self.burst = float(burst)
+        self.rate = float(rate)
+        self.level = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0 # Set from a 429's Retry-After
+
+    def reserve(self):
+        """Takes a send slot and returns how many seconds to wait before using it."""
+        now = time.monotonic()
+        self.level = min(self.burst, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        self.level -= 1
+        wait = -self.level / self.rate if self.level < 0 else 0.0
+        return max(wait, self.blocked_until - now)
+
+    def idle(self):
+        """True once the bucket has refilled, i.e. forgetting it changes nothing."""
+        now = time.monotonic()
+        return now >= self.blocked_until and self.level + (now - self.updated) * self.rate >= self.burst
+
+
+class _ChannelQueue:
+    def __init__(self, burst, rate):
+        self.lock = asyncio.Lock() # Hands the channel to waiting senders in FIFO order
+        self.pacer = _Pacer(burst, rate)
+        self.users = 0
+
+
+class OutboundSender:
+    """
+    Sends and edits Discord messages through one FIFO queue per channel.
+
+    discord.py consumes Discord's rate-limit headers itself and doesn't expose them, so each
+    channel is paced with a token bucket sized like Discord's per-channel message limit, plus
+    one bucket for the bot-wide limit. A 429 that still gets through pauses the channel for
+    its Retry-After and the request is tried once more.
+    """
+
+    def __init__(self, limit=DISCORD_MESSAGE_LIMIT, attach_after=8000, channel_burst=5,
+                 channel_rate=1.0, global_rate=45.0, attachment_name="keith-reply.md"):
+        self.limit = limit
+        self.attach_after = attach_after
+        self.channel_burst = channel_burst
+        self.channel_rate = channel_rate
+        self.global_pacer = _Pacer(global_rate, global_rate)
+        self.attachment_name = attachment_name
+        self.channels = {} # channel_id -> _ChannelQueue
+        self.waiting = 0 # Requests queued behind another one in their channel
+        self.rate_limited = 0 # 429s that made it past discord.py
+
+    # --- Public API ---
+    async def send(self, channel, text, **kwargs):
+        """
+        Sends text as one or more messages, or as a preview plus attachment if it is longer
+        than attach_after. The parts go out back to back, with no other sends to the channel
+        in between. kwargs (e.g. reference) apply to the first message. Returns the messages.
+        """
+        if len(text) > self.attach_after:
+            preview, file = self.as_attachment(text)
+            return [await self.post(channel, preview, file=file, **kwargs)]
+        sent = []
+        async with self._queue(channel.id) as queue:
+            for part in chunk_message(text, self.limit):
+                sent.append(await self._paced(queue, channel.send, part, **kwargs))
+                kwargs = {}
+        return sent
+
+    async def post(self, channel, content=None, **kwargs):
+        """Sends one message, which must already fit the limit. Returns it."""
+        async with self._queue(channel.id) as queue:
+            return await self._paced(queue, channel.send, content, **kwargs)
+
+    async def edit(self, message, **kwargs):
+        """Edits a message, queued with the sends to its channel. Returns the edited message."""
+        async with self._queue(message.channel.id) as queue:
+            return await self._paced(queue, message.edit, **kwargs)
+
+    def as_attachment(self, text):
+        """Returns (preview, discord.File) for sending a long text as an attachment."""
+        preview = chunk_message(text, self.limit - len(ATTACHMENT_NOTE) - 2)[0]
+        file = discord.File(io.BytesIO(text.encode("utf-8")), filename=self.attachment_name)
+        return f"{preview}\n\n{ATTACHMENT_NOTE}", file
+
+    def snapshot(self):
+        return {'waiting': self.waiting, 'channels': len(self.channels), 'rate_limited': self.rate_limited}
+
+    # --- Internals ---
+    def _queue(self, channel_id):
+        return _QueueSlot(self, channel_id)
+
+    def _release(self, channel_id, queue):
+        queue.users -= 1
+        if queue.users or not queue.pacer.idle():
+            if len(self.channels) > MAX_IDLE_CHANNELS:
+                self._sweep()
+            return
+        if self.channels.get(channel_id) is queue:
+            del self.channels[channel_id]
+
+    def _sweep(self):
+        for channel_id, queue in list(self.channels.items()):
+            if not queue.users and queue.pacer.idle():
+                del self.channels[channel_id]
+
+    async def _paced(self, queue, request, *args, **kwargs):
+        for attempt in range(2):
+            delay = max(queue.pacer.reserve(), self.global_pacer.reserve())
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                return await request(*args, **kwargs)
+            except discord.HTTPException as e:
+                if e.status != 429 or attempt:
+                    raise
+                retry_after = _retry_after(e)
+            except discord.RateLimited as e:
+                if attempt:
+                    raise
+                retry_after = e.retry_after
+            self.rate_limited += 1
+            log.warning(f"[Outbound] Discord rate-limited a request, pausing the channel for {retry_after:.1f}s.")
+            queue.pacer.blocked_until = time.monotonic() + retry_after
+
+
+def _retry_after(error):
+    try:
+        return float(error.response.headers.get("Retry-After", 1.0))
+    except (AttributeError, TypeError, ValueError):
+        return 1.0
+
+
+class _QueueSlot:
+    """async context manager: waits for a turn in a channel's queue."""
+
+    def __init__(self, sender, channel_id):
+        self.sender = sender
+        self.channel_id = channel_id
+        self.queue = None
+
+    async def __aenter__(self):
+        channels = self.sender.channels
+        queue = channels.get(self.channel_id)
+        if queue is None:
+            queue = channels[self.channel_id] = _ChannelQueue(self.sender.channel_burst, self.sender.channel_rate)
+        queue.users += 1
+        queued = queue.lock.locked()
+        self.sender.waiting += queued
+        try:
+            await queue.lock.acquire()
+        except BaseException:
+            self.sender._release(self.channel_id, queue)
+            raise
+        finally:
+            self.sender.waiting -= queued
+        self.queue = queue
+        return queue
+
+    async def __aexit__(self, *exc):
+        self.queue.lock.release()
+        self.sender._release(self.channel_id, self.queue)
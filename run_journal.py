@@ -0,0 +1,103 @@
+"""
+Durable journal of Keith's in-flight Assistants runs.
+
+Each run is written to the local SQLite file as soon as it is created and removed once
+it has been dealt with, so runs that were still going when the process stopped can be
+picked up again after a restart. Posting the reply is claimed atomically first, so a
+reply is never delivered twice even if two processes end up finishing the same run.
+"""
+import asyncio
+import logging
+import time
+
+from sqlite_db import sqlite_database
+
+log = logging.getLogger(__name__)
+
+
+class JournaledRun:
+    """One journal row: a run and the Discord message it is answering."""
+
+    def __init__(self, run_id, channel_id, guild_id, thread_id, message_id, placeholder_id, started_at, owner):
+        self.run_id = run_id
+        self.channel_id = channel_id
+        self.guild_id = guild_id
+        self.thread_id = thread_id
+        self.message_id = message_id
+        self.placeholder_id = placeholder_id # Streaming mode: the message the reply was being typed into
+        self.started_at = started_at # Wall-clock time, so it means something after a restart
+        self.owner = owner
+
+
+class RunJournal:
+    """
+    Journals runs under an `owner` ID that is unique per process. orphans() returns runs
+    whose owner is gone (any owner but us); adopt() takes one over, claim() reserves the
+    right to post its reply and remove() forgets it.
+    """
+
+    def __init__(self, path, owner):
+        self.path = path
+        self.owner = owner
+        self._database = sqlite_database(path, _create_table)
+
+    # --- Public API ---
+    async def add(self, run_id, channel_id, guild_id, thread_id, message_id, placeholder_id=None):
+        await asyncio.to_thread(
+            self._execute,
+            "INSERT OR REPLACE INTO run_journal (run_id, channel_id, guild_id, thread_id, message_id, "
+            "placeholder_id, started_at, owner, claimed) VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0)",
+            (run_id, channel_id, guild_id, thread_id, message_id, placeholder_id, time.time(), self.owner),
+        )
+
+    async def claim(self, run_id):
+        """Reserves delivery of a run's reply. Returns False if it was already claimed or removed."""
+        return await asyncio.to_thread(
+            self._execute, "UPDATE run_journal SET claimed = 1 WHERE run_id = ? AND claimed = 0", (run_id,),
+        ) == 1
+
+    async def remove(self, run_id):
+        await asyncio.to_thread(self._execute, "DELETE FROM run_journal WHERE run_id = ?", (run_id,))
+
+    async def orphans(self):
+        """Unclaimed runs journaled by other (presumably dead) processes, oldest first."""
+        rows = await asyncio.to_thread(
+            self._query,
+            "SELECT run_id, channel_id, guild_id, thread_id, message_id, placeholder_id, started_at, owner "
+            "FROM run_journal WHERE owner != ? AND claimed = 0 ORDER BY started_at",
+            (self.owner,),
+        )
+        return [JournaledRun(*row) for row in rows]
+
+    async def adopt(self, entry):
+        """Takes over an orphaned run. Returns False if another process adopted it first."""
+        adopted = await asyncio.to_thread(
+            self._execute, "UPDATE run_journal SET owner = ? WHERE run_id = ? AND owner = ? AND claimed = 0",
+            (self.owner, entry.run_id, entry.owner),
+        ) == 1
+        if adopted:
+            entry.owner = self.owner
+        return adopted
+
+    def close(self):
+        self._database.close()
+
+    # --- Internals ---
+    def _execute(self, sql, params):
+        """Runs one write in its own transaction. Returns the number of rows it changed."""
+        with self._database.connection() as db:
+            with db:
+                return db.execute(sql, params).rowcount
+
+    def _query(self, sql, params):
+        with self._database.connection() as db:
+            return db.execute(sql, params).fetchall()
+
+
+def _create_table(db):
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS run_journal ("
+        "run_id TEXT PRIMARY KEY, channel_id INTEGER NOT NULL, guild_id INTEGER, thread_id TEXT NOT NULL, "
+        "message_id INTEGER NOT NULL, placeholder_id INTEGER, started_at REAL NOT NULL, "
+        "owner TEXT NOT NULL, claimed INTEGER NOT NULL DEFAULT 0)"
+    )
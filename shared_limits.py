@@ -0,0 +1,103 @@
+"""
+OpenAI rate-limit state shared between Keith worker processes.
+
+In sharded mode every worker runs its own governor. Each worker periodically publishes
+how much request/token budget it has spent (and any 429 back-off it was told about) to
+a small table in the local SQLite file, and charges what the other workers spent since
+the last exchange against its own buckets. All workers thus draw down one shared budget
+instead of each assuming it has the whole API limit to itself.
+"""
+import asyncio
+import logging
+import time
+
+from sqlite_db import sqlite_database
+
+log = logging.getLogger(__name__)
+
+STALE_AFTER = 60 # Rows from workers that haven't synced for this many seconds are dropped
+
+
+class SharedRateLimits:
+    """
+    Exchanges a governor's spending with the other workers through `path`.
+    The governor needs `spent_requests`, `spent_tokens`, `blocked_until` (monotonic)
+    and an `absorb(requests, tokens, blocked_until)` method taking wall-clock time.
+    """
+
+    def __init__(self, path, worker_id, interval=1.0):
+        self.path = path
+        self.worker_id = str(worker_id)
+        self.interval = interval
+        self._seen = {} # other worker_id -> (requests, tokens) spent at the last exchange
+        self._database = sqlite_database(path, _create_table)
+        self._task = None
+
+    def start(self, governor):
+        """Starts the background exchange. Safe to call more than once."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._sync_loop(governor))
+
+    async def sync(self, governor):
+        """Publishes our spending and charges the other workers' new spending to `governor`."""
+        now = time.time()
+        blocked_for = governor.blocked_until - time.monotonic()
+        row = (self.worker_id, governor.spent_requests, governor.spent_tokens,
+               now + blocked_for if blocked_for > 0 else 0.0, now)
+        others = await asyncio.to_thread(self._exchange, row)
+        requests = tokens = blocked_until = 0.0
+        for worker_id, spent_requests, spent_tokens, worker_blocked_until in others:
+            last = self._seen.get(worker_id)
+            self._seen[worker_id] = (spent_requests, spent_tokens)
+            blocked_until = max(blocked_until, worker_blocked_until)
+            if last is not None: # Only spending since we first saw a worker counts
+                # A restarted worker starts counting from zero again
+                requests += max(0.0, spent_requests - last[0])
+                tokens += max(0.0, spent_tokens - last[1])
+        if requests or tokens or blocked_until > now:
+            governor.absorb(requests, tokens, blocked_until)
+
+    def close(self):
+        """Stops syncing and removes this worker's row. Used at shutdown."""
+        if self._task is not None:
+            self._task.cancel()
+        try:
+            with self._database.connection() as db:
+                with db:
+                    db.execute("DELETE FROM governor_workers WHERE worker_id = ?", (self.worker_id,))
+        finally:
+            self._database.close()
+
+    # --- Internals ---
+    async def _sync_loop(self, governor):
+        while True:
+            try:
+                await self.sync(governor)
+            except Exception as e:
+                log.error(f"[Shared Limits] Error syncing rate-limit state via {self.path}: {e}")
+            await asyncio.sleep(self.interval)
+
+    def _exchange(self, row):
+        with self._database.connection() as db:
+            with db:
+                db.execute(
+                    "INSERT INTO governor_workers (worker_id, spent_requests, spent_tokens, blocked_until, updated) "
+                    "VALUES (?, ?, ?, ?, ?) ON CONFLICT(worker_id) DO UPDATE SET "
+                    "spent_requests = excluded.spent_requests, spent_tokens = excluded.spent_tokens, "
+                    "blocked_until = excluded.blocked_until, updated = excluded.updated",
+                    row,
+                )
+                db.execute("DELETE FROM governor_workers WHERE updated < ?", (row[4] - STALE_AFTER,))
+                return db.execute(
+                    "SELECT worker_id, spent_requests, spent_tokens, blocked_until FROM governor_workers "
+                    "WHERE worker_id != ?",
+                    (self.worker_id,),
+                ).fetchall()
+
+
+def _create_table(db):
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS governor_workers ("
+        "worker_id TEXT PRIMARY KEY, spent_requests REAL NOT NULL, spent_tokens REAL NOT NULL, "
+        "blocked_until REAL NOT NULL, updated REAL NOT NULL)"
+    )
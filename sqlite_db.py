@@ -0,0 +1,68 @@
+"""
+The local SQLite file Keith keeps its state in.
+
+ThreadStore, RunJournal and SharedRateLimits each keep a table in the same file. They share
+one SqliteDatabase per path: a single connection in WAL mode, opened on first use, and a
+lock that serializes the worker threads asyncio.to_thread() runs queries in.
+"""
+import contextlib
+import os
+import sqlite3
+import threading
+
+_databases = {} # absolute path -> SqliteDatabase
+_databases_lock = threading.Lock()
+
+
+class SqliteDatabase:
+    """One connection to a SQLite file. Each user registers a schema(db) function that creates its tables."""
+
+    def __init__(self, path):
+        self.path = path
+        self._db = None
+        self._lock = threading.Lock()
+        self._schemas = []
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Holds the lock and yields the connection. Blocks, so call it from a worker thread."""
+        with self._lock:
+            if self._db is None:
+                self._db = self._open()
+            yield self._db
+
+    def add_schema(self, schema):
+        with self._lock:
+            if schema in self._schemas:
+                return
+            self._schemas.append(schema)
+            if self._db is not None:
+                schema(self._db)
+                self._db.commit()
+
+    def close(self):
+        """Closes the connection. The next use opens it again."""
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def _open(self):
+        db = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL") # Still safe if the process dies; only an OS crash can lose the last writes
+        for schema in self._schemas:
+            schema(db)
+        db.commit()
+        return db
+
+
+def sqlite_database(path, schema):
+    """Returns the shared SqliteDatabase for `path`, with schema(db) applied to it."""
+    key = os.path.abspath(path)
+    with _databases_lock:
+        database = _databases.get(key)
+        if database is None:
+            database = _databases[key] = SqliteDatabase(path)
+    database.add_schema(schema)
+    return database
@@ -0,0 +1,17 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+
+@pytest.fixture(scope="session")
+def bot():
+    """keith-bot.py, imported as a module (its file name isn't a valid module name)."""
+    spec = importlib.util.spec_from_file_location("keith_bot", os.path.join(REPO_DIR, "keith-bot.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,75 @@
+import asyncio
+import os
+import sys
+import time
+
+from conftest import REPO_DIR
+from run_journal import RunJournal
+from thread_store import ThreadStore
+
+sys.path.insert(0, os.path.join(REPO_DIR, "bench"))
+from fakes import FakeAssistantsServer, FakeChannel, FakeMessage, FakeUser
+
+GENERATION_DELAY = 0.5
+
+
+def answer_prompts(bot, monkeypatch, tmp_path, channel_count, max_concurrent_runs):
+    """
+    Sends one Keith prompt in each of channel_count channels at once, through on_message and
+    against the fake Assistants server. Returns (seconds until all were answered, how long
+    each reply took, most replies in flight at the same time).
+    """
+    monkeypatch.setattr(bot, "ASSISTANT_ID", "asst_fake")
+    monkeypatch.setattr(bot, "COALESCE_WINDOW", 0)
+    monkeypatch.setattr(bot, "thread_store", ThreadStore(str(tmp_path / f"threads-{channel_count}.db")))
+    monkeypatch.setattr(bot, "run_journal", RunJournal(str(tmp_path / f"threads-{channel_count}.db"), bot.boot_id))
+    in_flight = peak = 0
+    durations = []
+    answer_prompt = bot.answer_prompt
+
+    async def counting_answer_prompt(*args):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        start = time.monotonic()
+        try:
+            await answer_prompt(*args)
+        finally:
+            durations.append(time.monotonic() - start)
+            in_flight -= 1
+
+    monkeypatch.setattr(bot, "answer_prompt", counting_answer_prompt)
+
+    async def scenario():
+        monkeypatch.setattr(bot, "run_semaphore", asyncio.Semaphore(max_concurrent_runs))
+        monkeypatch.setattr(bot, "openai_governor", bot.OpenAIGovernor(10000, 10**8, 1000))
+        server = await FakeAssistantsServer(queue_delay=0.05, generation_delay=GENERATION_DELAY).start()
+        monkeypatch.setattr(bot, "client_openai", bot.make_openai_client("sk-fake", base_url=server.url))
+        author = FakeUser(42, "tester")
+        channels = [FakeChannel(700000 + channel_count * 100 + i) for i in range(channel_count)]
+        try:
+            start = time.monotonic()
+            for channel in channels:
+                await bot.on_message(FakeMessage(channel, author, "Keith how long does this take?"))
+            await asyncio.wait_for(asyncio.gather(*(bot.channel_workers[c.id] for c in channels)), timeout=20)
+            return time.monotonic() - start, channels
+        finally:
+            await bot.client_openai.close()
+            await server.stop()
+
+    elapsed, channels = asyncio.run(scenario())
+    assert all(c.final_text() and "Sorry" not in c.final_text() for c in channels)
+    return elapsed, durations, peak
+
+
+def test_simultaneous_prompts_take_about_as_long_as_one(bot, monkeypatch, tmp_path):
+    elapsed, durations, peak = answer_prompts(bot, monkeypatch, tmp_path, 12, max_concurrent_runs=16)
+    assert peak == 12
+    assert min(durations) >= GENERATION_DELAY
+    assert elapsed < max(durations) * 1.2 # Not 12 times as long as one reply
+
+
+def test_max_concurrent_runs_limits_overlapping_runs(bot, monkeypatch, tmp_path):
+    elapsed, durations, peak = answer_prompts(bot, monkeypatch, tmp_path, 6, max_concurrent_runs=2)
+    assert peak == 2
+    assert elapsed > 3 * min(durations) # Three rounds of two replies each
@@ -0,0 +1,63 @@
+import json
+
+
+def load(bot, monkeypatch, tmp_path, settings, file_values=None, env=None):
+    path = tmp_path / "keith_config.json"
+    if file_values is not None:
+        path.write_text(json.dumps(file_values))
+    monkeypatch.setattr(bot, "CONFIG_PATH", str(path))
+    monkeypatch.setattr(bot, "config_errors", [])
+    monkeypatch.setattr(bot, "config_file_loaded", False)
+    for name, value in (env or {}).items():
+        monkeypatch.setenv(name, value)
+    namespace = dict(settings)
+    bot.load_config(namespace)
+    return namespace, bot.config_errors
+
+
+def test_env_null_turns_a_threshold_off(bot, monkeypatch, tmp_path):
+    settings, errors = load(bot, monkeypatch, tmp_path, {"COMPACT_ROLLOVER_MESSAGES": 200},
+                            env={"KEITH_COMPACT_ROLLOVER_MESSAGES": "null"})
+    assert errors == []
+    assert settings["COMPACT_ROLLOVER_MESSAGES"] is None
+
+
+def test_env_null_is_rejected_for_other_numbers(bot, monkeypatch, tmp_path):
+    settings, errors = load(bot, monkeypatch, tmp_path, {"MAX_CONCURRENT_RUNS": 16},
+                            env={"KEITH_MAX_CONCURRENT_RUNS": "null"})
+    assert len(errors) == 1 and "KEITH_MAX_CONCURRENT_RUNS" in errors[0]
+    assert settings["MAX_CONCURRENT_RUNS"] == 16
+
+
+def test_env_json_must_match_the_default_type(bot, monkeypatch, tmp_path):
+    settings, errors = load(bot, monkeypatch, tmp_path, {"CHANNEL_BACKENDS": {}},
+                            env={"KEITH_CHANNEL_BACKENDS": "5"})
+    assert errors == ["Invalid value for KEITH_CHANNEL_BACKENDS: expected a JSON object, got 5"]
+    assert settings["CHANNEL_BACKENDS"] == {}
+
+
+def test_file_values_are_type_checked(bot, monkeypatch, tmp_path):
+    defaults = {"MAX_CONCURRENT_RUNS": 16, "STREAM_RESPONSES": True, "RUN_TIMEOUT": 300,
+                "STREAM_EDIT_INTERVAL": 1.0, "COMPACT_TRUNCATE_TOKENS": 8000, "CHAT_MODEL": None,
+                "CHANNEL_BACKENDS": {}}
+    file_values = {"MAX_CONCURRENT_RUNS": "16", "STREAM_RESPONSES": 1, "RUN_TIMEOUT": True,
+                   "STREAM_EDIT_INTERVAL": 2, "COMPACT_TRUNCATE_TOKENS": None, "CHAT_MODEL": "gpt-4o",
+                   "CHANNEL_BACKENDS": {"1234": "chat"}}
+    settings, errors = load(bot, monkeypatch, tmp_path, defaults, file_values=file_values)
+    assert sorted(error.split(" in ")[0] for error in errors) == [
+        "Invalid value for MAX_CONCURRENT_RUNS", "Invalid value for RUN_TIMEOUT",
+        "Invalid value for STREAM_RESPONSES"]
+    assert settings == {"MAX_CONCURRENT_RUNS": 16, "STREAM_RESPONSES": True, "RUN_TIMEOUT": 300,
+                        "STREAM_EDIT_INTERVAL": 2.0, "COMPACT_TRUNCATE_TOKENS": None,
+                        "CHAT_MODEL": "gpt-4o", "CHANNEL_BACKENDS": {1234: "chat"}}
+
+
+def test_check_config_rejects_an_unknown_log_level(bot, monkeypatch):
+    for name, value in {"BOT_TOKEN": "token", "OPENAI_API_KEY": "sk-test", "ASSISTANT_ID": "asst_test",
+                        "ALLOWED_USER_ID": 42}.items():
+        monkeypatch.setattr(bot, name, value)
+    monkeypatch.setattr(bot, "config_errors", [])
+    monkeypatch.setattr(bot, "LOG_LEVEL", "DEBUG")
+    assert bot.check_config()
+    monkeypatch.setattr(bot, "LOG_LEVEL", "VERBOSE")
+    assert not bot.check_config()
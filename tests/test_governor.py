@@ -0,0 +1,86 @@
+import asyncio
+import types
+
+import pytest
+
+
+def run(coro):
+    return asyncio.run(asyncio.wait_for(coro, timeout=5))
+
+
+def test_call_bigger_than_bucket_is_admitted(bot):
+    async def scenario():
+        governor = bot.OpenAIGovernor(500, 10000, 10)
+        await asyncio.wait_for(governor.acquire(bot.PRIORITY_NEW_RUN, tokens=20000), timeout=1)
+        assert governor.spent_tokens == 20000 # Charged its full estimate
+    run(scenario())
+
+
+def test_call_bigger_than_bucket_waits_only_for_its_lane_share(bot):
+    async def scenario():
+        governor = bot.OpenAIGovernor(500, 10000, 10)
+        governor.tokens.level = 9990 # 10 tokens (0.06s) short of the whole bucket
+        await asyncio.wait_for(governor.acquire(bot.PRIORITY_NEW_RUN, tokens=20000), timeout=1)
+    run(scenario())
+
+
+def test_calls_queued_behind_a_big_call_go_out_once_the_bucket_refills(bot):
+    async def scenario():
+        governor = bot.OpenAIGovernor(500, 10000, 10)
+        governor.tokens.level = 5000
+        big = asyncio.create_task(governor.acquire(bot.PRIORITY_NEW_RUN, tokens=20000))
+        small = asyncio.create_task(governor.acquire(bot.PRIORITY_NEW_RUN, tokens=10))
+        await asyncio.sleep(0.1)
+        assert not big.done() and not small.done()
+        governor.tokens.updated -= 60 # A minute passes: the bucket is full again
+        governor._dispatch()
+        await asyncio.wait_for(big, timeout=1)
+        governor.tokens.updated -= 180 # ...and refills after the big call's overdraft
+        governor._dispatch()
+        await asyncio.wait_for(small, timeout=1)
+    run(scenario())
+
+
+def test_control_calls_can_use_the_whole_bucket(bot):
+    async def scenario():
+        governor = bot.OpenAIGovernor(500, 10000, 10)
+        await asyncio.wait_for(governor.acquire(bot.PRIORITY_CONTROL, tokens=50000), timeout=1)
+    run(scenario())
+
+
+def _status_error(cls, status):
+    response = types.SimpleNamespace(status_code=status, headers={}, request=None)
+    return cls("injected", response=response, body=None)
+
+
+def test_openai_client_leaves_retries_to_the_governor(bot):
+    client = bot.make_openai_client("sk-test")
+    assert client.max_retries == 0
+
+
+def test_retries_go_through_the_governor(bot, monkeypatch):
+    governor = bot.OpenAIGovernor(500, 10000, 10)
+    monkeypatch.setattr(bot, "openai_governor", governor)
+    failures = [_status_error(bot.openai.RateLimitError, 429), _status_error(bot.openai.InternalServerError, 500)]
+
+    async def flaky():
+        if failures:
+            raise failures.pop(0)
+        return "ok"
+
+    assert run(bot.call_openai(bot.PRIORITY_NORMAL, flaky)) == "ok"
+    assert governor.spent_requests == 3 # Every attempt was admitted and counted
+
+
+def test_retries_give_up_after_openai_max_retries(bot, monkeypatch):
+    monkeypatch.setattr(bot, "openai_governor", bot.OpenAIGovernor(500, 10000, 10))
+    monkeypatch.setattr(bot, "OPENAI_MAX_RETRIES", 1)
+    calls = []
+
+    async def failing():
+        calls.append(1)
+        raise _status_error(bot.openai.RateLimitError, 429)
+
+    with pytest.raises(bot.openai.RateLimitError):
+        run(bot.call_openai(bot.PRIORITY_NORMAL, failing))
+    assert len(calls) == 2
@@ -0,0 +1,35 @@
+import asyncio
+import time
+
+
+def test_lines_typed_within_the_window_are_joined(bot, monkeypatch):
+    monkeypatch.setattr(bot, "MANUAL_BATCH_WINDOW", 0.3)
+
+    async def scenario():
+        monkeypatch.setattr(bot, "manual_queue", asyncio.Queue())
+        loop = asyncio.get_running_loop()
+        for delay, channel_id, text in [(0.1, 1, "second"), (0.2, 1, "third"), (0.5, 1, "too late")]:
+            loop.call_later(delay, lambda c=channel_id, t=text: bot.manual_queue.put_nowait((c, t, time.monotonic())))
+        return await bot._take_batch((1, "first", time.monotonic()))
+
+    texts, carried = asyncio.run(scenario())
+    assert texts == ["first", "second", "third"]
+    assert carried is None # "too late" arrives after the batch was sent
+
+
+def test_a_batch_stops_at_another_channel_or_the_message_limit(bot, monkeypatch):
+    monkeypatch.setattr(bot, "MANUAL_BATCH_WINDOW", 0.3)
+
+    async def scenario():
+        monkeypatch.setattr(bot, "manual_queue", asyncio.Queue())
+        now = time.monotonic()
+        bot.manual_queue.put_nowait((1, "y" * 1990, now))
+        bot.manual_queue.put_nowait((1, "y" * 20, now))
+        first = await bot._take_batch((1, "x", now))
+        bot.manual_queue.put_nowait((2, "elsewhere", now))
+        second = await bot._take_batch((1, "x", now))
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert first == (["x", "y" * 1990], (1, "y" * 20, first[1][2]))
+    assert second[0] == ["x"] and second[1][0] == 2
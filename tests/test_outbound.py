@@ -0,0 +1,56 @@
+from outbound import chunk_message
+
+
+def test_short_text_is_one_chunk():
+    assert chunk_message("Hello\nthere") == ["Hello\nthere"]
+
+
+def test_splits_at_line_breaks():
+    lines = [f"line {n} " + "x" * 90 for n in range(50)]
+    chunks = chunk_message("\n".join(lines))
+    assert all(len(c) <= 2000 for c in chunks)
+    assert "\n".join(chunks).splitlines() == lines
+
+
+def test_long_line_is_cut_at_a_space():
+    words = " ".join(f"word{n}" for n in range(1000))
+    chunks = chunk_message(words)
+    assert len(chunks) > 1
+    assert all(len(c) <= 2000 for c in chunks)
+    assert all(c.endswith(" ") or c is chunks[-1] for c in chunks)
+    assert "".join(chunks) == words
+
+
+def test_long_line_without_spaces_is_cut_hard():
+    chunks = chunk_message("y" * 4500)
+    assert [len(c) for c in chunks] == [2000, 2000, 500]
+
+
+def test_code_block_is_closed_and_reopened_with_its_language():
+    code = "\n".join(f"print({n})  # " + "z" * 40 for n in range(100))
+    chunks = chunk_message(f"Here you go:\n```python\n{code}\n```\nDone.")
+    assert len(chunks) > 1
+    assert all(len(c) <= 2000 for c in chunks)
+    assert chunks[0].startswith("Here you go:\n```python\n")
+    for chunk in chunks[:-1]:
+        assert chunk.endswith("\n```")
+    for chunk in chunks[1:]:
+        assert chunk.startswith("```python\n")
+    body = [line for c in chunks for line in c.splitlines() if line.startswith("print(")]
+    assert body == code.splitlines()
+
+
+def test_no_empty_code_block_when_the_first_line_is_too_long():
+    chunks = chunk_message("```\n" + "y" * 4500 + "\n```")
+    assert [len(c) for c in chunks] == [2000, 2000, 524]
+    assert all(c.startswith("```\ny") and c.endswith("y\n```") for c in chunks)
+
+
+def test_no_empty_code_block_after_an_intro():
+    chunks = chunk_message("Intro\n```\n" + "y" * 4500 + "\n```")
+    assert chunks[0] == "Intro"
+    assert all(c.startswith("```\ny") and c.endswith("y\n```") for c in chunks[1:])
+
+
+def test_unclosed_code_block_is_closed():
+    assert chunk_message("```js\nlet x = 1;") == ["```js\nlet x = 1;\n```"]
@@ -0,0 +1,106 @@
+import asyncio
+import itertools
+import os
+import sys
+import types
+
+import pytest
+
+from conftest import REPO_DIR
+from run_journal import RunJournal
+from thread_store import ThreadStore
+
+sys.path.insert(0, os.path.join(REPO_DIR, "bench"))
+from fakes import FakeAssistantsServer, FakeChannel, FakeMessage, FakeUser
+
+ids = itertools.count(1)
+
+
+def make_message(channel_id, text):
+    author = types.SimpleNamespace(display_name="tester")
+    return types.SimpleNamespace(id=next(ids), channel=types.SimpleNamespace(id=channel_id), author=author, content=text)
+
+
+class RecordingBackend:
+    def __init__(self, delay):
+        self.delay = delay
+        self.prompts = []
+
+    async def respond(self, message, user_prompt, received_at):
+        self.prompts.append(user_prompt)
+        await asyncio.sleep(self.delay)
+
+
+def test_deleting_the_only_buffered_prompt_during_the_coalesce_wait(bot, monkeypatch):
+    backend = RecordingBackend(delay=0.1)
+    monkeypatch.setattr(bot, "backend_for", lambda channel_id: backend)
+    monkeypatch.setattr(bot, "COALESCE_WINDOW", 0.3)
+    channel_id = 501
+
+    async def scenario():
+        first, second = make_message(channel_id, "Keith one"), make_message(channel_id, "Keith two")
+        await bot.enqueue_prompt(first, "one")
+        await asyncio.sleep(0.01)
+        await bot.enqueue_prompt(second, "two") # Buffered behind the first run
+        worker = bot.channel_workers[channel_id]
+        await asyncio.sleep(0.15) # First run done, worker is waiting out the coalesce window
+        await bot.supersede_prompt(channel_id, second.id, None, "deleted")
+        await asyncio.wait_for(worker, timeout=1) # Raises if the worker died
+        assert channel_id not in bot.channel_queues
+        assert channel_id not in bot.channel_workers
+
+    asyncio.run(scenario())
+    assert backend.prompts == ["one"]
+
+
+def test_editing_a_buffered_prompt_updates_it_in_place(bot, monkeypatch):
+    backend = RecordingBackend(delay=0.1)
+    monkeypatch.setattr(bot, "backend_for", lambda channel_id: backend)
+    monkeypatch.setattr(bot, "COALESCE_WINDOW", 0.05)
+    channel_id = 502
+
+    async def scenario():
+        first, second = make_message(channel_id, "Keith one"), make_message(channel_id, "Keith two")
+        await bot.enqueue_prompt(first, "one")
+        await asyncio.sleep(0.01)
+        await bot.enqueue_prompt(second, "two")
+        await bot.supersede_prompt(channel_id, second.id, "two, corrected", "edited")
+        await asyncio.wait_for(bot.channel_workers[channel_id], timeout=1)
+
+    asyncio.run(scenario())
+    assert backend.prompts == ["one", "two, corrected"]
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_editing_a_prompt_while_its_run_is_being_created(bot, monkeypatch, tmp_path, stream):
+    monkeypatch.setattr(bot, "ASSISTANT_ID", "asst_fake")
+    monkeypatch.setattr(bot, "STREAM_RESPONSES", stream)
+    monkeypatch.setattr(bot, "COALESCE_WINDOW", 0)
+    monkeypatch.setattr(bot, "thread_store", ThreadStore(str(tmp_path / "threads.db")))
+    monkeypatch.setattr(bot, "run_journal", RunJournal(str(tmp_path / "threads.db"), bot.boot_id))
+
+    async def scenario():
+        server = await FakeAssistantsServer(queue_delay=0.05, generation_delay=0.2, create_run_latency=0.3).start()
+        monkeypatch.setattr(bot, "client_openai", bot.make_openai_client("sk-fake", base_url=server.url))
+        channel = FakeChannel(503)
+        message = FakeMessage(channel, FakeUser(42, "tester"), "Keith one")
+        try:
+            await bot.on_message(message)
+            while not server.runs:
+                await asyncio.sleep(0.01)
+            # The run exists on the server, but runs.create hasn't returned yet
+            await bot.supersede_prompt(channel.id, message.id, "one, corrected", "edited")
+            await asyncio.wait_for(bot.channel_workers[channel.id], timeout=5)
+        finally:
+            await bot.client_openai.close()
+            await server.stop()
+        return server, channel
+
+    server, channel = asyncio.run(scenario())
+    first, second = server.runs.values()
+    assert first["status"] == "cancelled"
+    assert second["status"] == "completed"
+    (thread,) = server.threads.values()
+    assert [m["content"][0]["text"]["value"] for m in thread if m["role"] == "user"] == ["one, corrected"]
+    assert [m["run_id"] for m in thread if m["role"] == "assistant"] == [second["id"]]
+    assert len(channel.visible()) == 1
@@ -0,0 +1,63 @@
+import asyncio
+import time
+import types
+
+
+class StubRuns:
+    """runs.retrieve that stalls for the runs in `stalled`, once each, and finds every run completed."""
+
+    def __init__(self, stalled, stall_for):
+        self.stalled = set(stalled)
+        self.stall_for = stall_for
+        self.calls = []
+
+    async def retrieve(self, thread_id, run_id):
+        self.calls.append(run_id)
+        if run_id in self.stalled:
+            self.stalled.discard(run_id)
+            await asyncio.sleep(self.stall_for)
+        return types.SimpleNamespace(id=run_id, status="completed")
+
+
+def run_in_progress(run_id):
+    return types.SimpleNamespace(id=run_id, status="in_progress")
+
+
+def stub_client(bot, monkeypatch, runs):
+    client = types.SimpleNamespace(beta=types.SimpleNamespace(threads=types.SimpleNamespace(runs=runs)))
+    monkeypatch.setattr(bot, "client_openai", client)
+    monkeypatch.setattr(bot, "POLL_INITIAL_INTERVAL", 0.05)
+
+
+def test_a_stalled_poll_does_not_hold_up_other_runs(bot, monkeypatch):
+    runs = StubRuns(stalled={"run_slow"}, stall_for=10)
+    stub_client(bot, monkeypatch, runs)
+
+    async def scenario():
+        monkeypatch.setattr(bot, "openai_governor", bot.OpenAIGovernor(10000, 10**7, 100))
+        poller = bot.RunPoller()
+        slow = asyncio.create_task(poller.wait("thread_1", run_in_progress("run_slow"), 1))
+        await asyncio.sleep(0.1) # The slow run's poll is now stuck
+        start = time.monotonic()
+        run = await asyncio.wait_for(poller.wait("thread_2", run_in_progress("run_fast"), 2), timeout=2)
+        elapsed = time.monotonic() - start
+        slow.cancel()
+        return run, elapsed
+
+    run, elapsed = asyncio.run(scenario())
+    assert run.status == "completed"
+    assert elapsed < 0.5
+
+
+def test_a_stalled_poll_is_given_up_and_retried(bot, monkeypatch):
+    runs = StubRuns(stalled={"run_slow"}, stall_for=10)
+    stub_client(bot, monkeypatch, runs)
+    monkeypatch.setattr(bot, "POLL_REQUEST_TIMEOUT", 0.2)
+
+    async def scenario():
+        monkeypatch.setattr(bot, "openai_governor", bot.OpenAIGovernor(10000, 10**7, 100))
+        poller = bot.RunPoller()
+        return await asyncio.wait_for(poller.wait("thread_1", run_in_progress("run_slow"), 1), timeout=5)
+
+    assert asyncio.run(scenario()).status == "completed"
+    assert runs.calls == ["run_slow", "run_slow"]
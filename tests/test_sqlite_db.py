@@ -0,0 +1,28 @@
+import asyncio
+
+from run_journal import RunJournal
+from shared_limits import SharedRateLimits
+from sqlite_db import sqlite_database
+from thread_store import ThreadStore
+
+
+def test_stores_in_one_file_share_a_connection(tmp_path):
+    path = str(tmp_path / "keith.db")
+    store, journal = ThreadStore(path), RunJournal(path, "owner-1")
+    limits = SharedRateLimits(path, worker_id=0)
+    assert store._database is journal._database is limits._database is sqlite_database(path, lambda db: None)
+
+    async def scenario():
+        store.set(1, "thread_1")
+        await store.flush()
+        await journal.add("run_1", 1, None, "thread_1", 100)
+        store.close() # Closes the shared connection; the journal reopens it on next use
+        assert await journal.claim("run_1")
+        store._cache.clear()
+        return await store.get(1)
+
+    assert asyncio.run(scenario()) == "thread_1"
+    with store._database.connection() as db:
+        tables = {row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    assert tables == {"channel_threads", "run_journal", "governor_workers"}
+    limits.close()
@@ -0,0 +1,84 @@
+import asyncio
+import os
+import sys
+
+from conftest import REPO_DIR
+from outbound import OutboundSender
+
+sys.path.insert(0, os.path.join(REPO_DIR, "bench"))
+from fakes import FakeChannel
+
+
+def streaming_reply(bot, monkeypatch, interval, attach_after=8000):
+    monkeypatch.setattr(bot, "STREAM_EDIT_INTERVAL", interval)
+    monkeypatch.setattr(bot, "ATTACH_REPLIES_OVER", attach_after)
+    monkeypatch.setattr(bot, "outbound", OutboundSender(2000, attach_after, channel_burst=100, channel_rate=100))
+    channel = FakeChannel(601)
+    return bot.StreamingReply(channel, received_at=0.0), channel
+
+
+def contents(channel):
+    return [m.content for _, m in channel.visible()]
+
+
+def test_first_text_shows_at_once_and_later_edits_are_throttled(bot, monkeypatch):
+    reply, channel = streaming_reply(bot, monkeypatch, interval=0.3)
+
+    async def scenario():
+        await reply.start()
+        assert contents(channel) == [bot.STREAM_PLACEHOLDER]
+        await reply.add("Hello")
+        assert contents(channel) == ["Hello"] # No wait for the edit interval
+        await reply.add(" world")
+        assert contents(channel) == ["Hello"] # Throttled
+        await asyncio.sleep(0.35)
+        await reply.add("!")
+        assert contents(channel) == ["Hello world!"]
+        await reply.finish("fallback")
+
+    asyncio.run(scenario())
+    assert contents(channel) == ["Hello world!"]
+    assert len(channel.edits) == 2
+
+
+def test_long_reply_rolls_over_into_new_messages(bot, monkeypatch):
+    reply, channel = streaming_reply(bot, monkeypatch, interval=0)
+    deltas = ["".join(f"word{n} " for n in range(start, start + 70)) for start in range(0, 700, 70)]
+
+    async def scenario():
+        await reply.start()
+        for delta in deltas:
+            await reply.add(delta)
+        await reply.finish("fallback")
+
+    asyncio.run(scenario())
+    shown = contents(channel)
+    assert len(shown) == 3
+    assert all(len(text) <= 2000 for text in shown)
+    assert "".join(shown).rstrip() == "".join(deltas).rstrip()
+
+
+def test_fallback_text_when_nothing_was_generated(bot, monkeypatch):
+    reply, channel = streaming_reply(bot, monkeypatch, interval=0.3)
+
+    async def scenario():
+        await reply.start()
+        await reply.finish("Sorry, no answer.")
+
+    asyncio.run(scenario())
+    assert contents(channel) == ["Sorry, no answer."]
+
+
+def test_very_long_reply_becomes_an_attachment(bot, monkeypatch):
+    reply, channel = streaming_reply(bot, monkeypatch, interval=0, attach_after=3000)
+
+    async def scenario():
+        await reply.start()
+        for start in range(0, 800, 80):
+            await reply.add("".join(f"word{n} " for n in range(start, start + 80)))
+        await reply.finish("fallback")
+
+    asyncio.run(scenario())
+    ((_, message),) = channel.visible()
+    assert message.content.endswith("attached.)*")
+    assert len(message.files) == 1
@@ -0,0 +1,199 @@
+"""
+Persistent channel -> OpenAI thread mapping for Keith.
+
+Lookups are served from an in-memory LRU cache. Writes are queued and flushed to a
+local SQLite file in batches by a background task, so the Discord event loop never
+waits on disk for the common case.
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+from sqlite_db import sqlite_database
+
+log = logging.getLogger(__name__)
+
+_DELETED = object() # Marks a pending delete in the write-behind buffer
+TOUCH_RESOLUTION = 60 # Only persist a new last_used time if the old one is this many seconds stale
+
+
+class ThreadStore:
+    """
+    Maps Discord channel IDs to OpenAI thread IDs, along with rough size stats for each
+    thread (message count and estimated context tokens) used for compaction decisions.
+
+    get() is a coroutine because a cache miss has to look in SQLite (done in a worker thread);
+    set() and invalidate() only touch memory and are written out on the next flush.
+    Entries unused for longer than ttl seconds expire.
+    """
+
+    def __init__(self, path, cache_size=10000, ttl=30 * 24 * 3600, flush_interval=2.0):
+        self.path = path
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        # channel_id -> (thread_id, last_used, message_count, token_estimate), most recent last
+        self._cache = OrderedDict()
+        self._dirty = {} # channel_id -> same tuple, or _DELETED
+        self._database = sqlite_database(path, _create_tables)
+        self._flush_task = None
+        self._last_purge = 0.0
+
+    # --- Public API ---
+    def start(self):
+        """Starts the background flusher and warms the cache. Safe to call more than once."""
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def get(self, channel_id):
+        """Returns the thread ID for a channel, or None if there isn't a live one."""
+        now = time.time()
+        entry = self._cache.get(channel_id)
+        if entry is None:
+            entry = self._dirty.get(channel_id)
+            if entry is _DELETED:
+                return None
+            if entry is None:
+                entry = await asyncio.to_thread(self._db_get, channel_id)
+                if entry is None:
+                    return None
+                # The channel may have been set/invalidated while we were reading
+                if channel_id in self._dirty or channel_id in self._cache:
+                    return await self.get(channel_id)
+        thread_id, last_used, message_count, token_estimate = entry
+        if now - last_used > self.ttl:
+            self.invalidate(channel_id)
+            return None
+        if now - last_used > TOUCH_RESOLUTION:
+            entry = (thread_id, now, message_count, token_estimate)
+            self._dirty[channel_id] = entry
+        self._remember(channel_id, entry)
+        return thread_id
+
+    def set(self, channel_id, thread_id, message_count=0, token_estimate=0):
+        entry = (thread_id, time.time(), message_count, token_estimate)
+        self._remember(channel_id, entry)
+        self._dirty[channel_id] = entry
+
+    def usage(self, channel_id):
+        """Returns (message_count, token_estimate) for a channel's thread. Call after get()."""
+        entry = self._cache.get(channel_id)
+        if entry is None:
+            return 0, 0
+        return entry[2], entry[3]
+
+    def record_usage(self, channel_id, messages_added, token_estimate):
+        """Updates a thread's size stats after a run."""
+        entry = self._cache.get(channel_id)
+        if entry is None:
+            return
+        entry = (entry[0], time.time(), entry[2] + messages_added, int(token_estimate))
+        self._remember(channel_id, entry)
+        self._dirty[channel_id] = entry
+
+    def invalidate(self, channel_id):
+        """Forgets a channel's thread (e.g. it was deleted on OpenAI's side)."""
+        self._cache.pop(channel_id, None)
+        self._dirty[channel_id] = _DELETED
+
+    async def flush(self):
+        """Writes all pending changes to disk."""
+        if not self._dirty:
+            return
+        batch, self._dirty = self._dirty, {}
+        try:
+            await asyncio.to_thread(self._db_write, batch)
+        except Exception:
+            # Put the batch back (newer changes win) so the next flush retries it
+            self._dirty = {**batch, **self._dirty}
+            raise
+
+    def close(self):
+        """Synchronously flushes pending writes and closes the database. Used at shutdown."""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+        batch, self._dirty = self._dirty, {}
+        if batch:
+            self._db_write(batch)
+        self._database.close()
+
+    def __len__(self):
+        return len(self._cache)
+
+    # --- Internals ---
+    def _remember(self, channel_id, entry):
+        self._cache[channel_id] = entry
+        self._cache.move_to_end(channel_id)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def _flush_loop(self):
+        rows = await asyncio.to_thread(self._load_recent)
+        self._warm(rows)
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                log.error(f"[Thread Store] Error flushing to {self.path}: {e}")
+
+    def _load_recent(self):
+        with self._database.connection() as db:
+            return db.execute(
+                "SELECT channel_id, thread_id, last_used, message_count, token_estimate FROM channel_threads "
+                "WHERE last_used >= ? "
+                "ORDER BY last_used DESC LIMIT ?",
+                (time.time() - self.ttl, self.cache_size),
+            ).fetchall()
+
+    def _warm(self, rows):
+        """Loads the most recently used mappings (newest first) into the cache."""
+        # Warmed entries are older than anything cached since startup, so they go at the LRU end
+        for channel_id, *entry in rows:
+            if channel_id not in self._cache and channel_id not in self._dirty:
+                self._cache[channel_id] = tuple(entry)
+                self._cache.move_to_end(channel_id, last=False)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        log.info(f"[Thread Store] Loaded {len(rows)} channel threads from {self.path}.")
+
+    def _db_get(self, channel_id):
+        with self._database.connection() as db:
+            return db.execute(
+                "SELECT thread_id, last_used, message_count, token_estimate FROM channel_threads WHERE channel_id = ?",
+                (channel_id,),
+            ).fetchone()
+
+    def _db_write(self, batch):
+        upserts = [(cid, *e) for cid, e in batch.items() if e is not _DELETED]
+        deletes = [(cid,) for cid, e in batch.items() if e is _DELETED]
+        with self._database.connection() as db:
+            with db:
+                if upserts:
+                    db.executemany(
+                        "INSERT INTO channel_threads (channel_id, thread_id, last_used, message_count, token_estimate) "
+                        "VALUES (?, ?, ?, ?, ?) ON CONFLICT(channel_id) DO UPDATE SET thread_id = excluded.thread_id, "
+                        "last_used = excluded.last_used, message_count = excluded.message_count, "
+                        "token_estimate = excluded.token_estimate",
+                        upserts,
+                    )
+                if deletes:
+                    db.executemany("DELETE FROM channel_threads WHERE channel_id = ?", deletes)
+                now = time.time()
+                if now - self._last_purge > 3600:
+                    db.execute("DELETE FROM channel_threads WHERE last_used < ?", (now - self.ttl,))
+                    self._last_purge = now
+
+
+def _create_tables(db):
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS channel_threads ("
+        "channel_id INTEGER PRIMARY KEY, thread_id TEXT NOT NULL, last_used REAL NOT NULL, "
+        "message_count INTEGER NOT NULL DEFAULT 0, token_estimate INTEGER NOT NULL DEFAULT 0)"
+    )
+    columns = {row[1] for row in db.execute("PRAGMA table_info(channel_threads)")}
+    for column in ("message_count", "token_estimate"): # Files created before thread stats existed
+        if column not in columns:
+            db.execute(f"ALTER TABLE channel_threads ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0")
+    db.execute("CREATE INDEX IF NOT EXISTS channel_threads_last_used ON channel_threads(last_used)")